@@ -0,0 +1,101 @@
+# -*- coding: utf-8 -*-
+"""
+Forks prefork-style workers that log lines larger than PIPE_BUF to a
+shared pipe, once with plain stream handlers and once in aggregate mode,
+and counts the lines that came out broken. In aggregate mode the
+aggregator is killed halfway through, to check that workers recover.
+Run from the repository root with
+
+    python -m benchmarks.bench_aggregator
+"""
+import copy
+import json
+import os
+import signal
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+WORKERS = 8
+RECORDS = 500
+PAYLOAD = 'x' * 16384
+
+
+def worker(mode, socket_path):
+    import structlog
+
+    from gcpi.stackdriverlog import conf
+
+    config = copy.deepcopy(conf.DEFAULTS['LOGGING'])
+    config['handlers']['console']['stream'] = 'ext://sys.stdout'
+    conf.init({'LOGGING': config, 'HANDLER_MODE': mode, 'NATIVE_RENDERING': True, 'AGGREGATOR_SOCKET': socket_path})
+    log = structlog.get_logger('bench')
+
+    pids = []
+    for _ in range(WORKERS):
+        pid = os.fork()
+        if pid == 0:
+            for i in range(RECORDS):
+                log.info('line', i=i, payload=PAYLOAD)
+                if mode == 'aggregate' and i == RECORDS // 2 and os.getpid() == min(pids + [os.getpid()]):
+                    kill_aggregator(socket_path)
+            # Like a recycled worker, exit through logging.shutdown().
+            sys.exit(0)
+        pids.append(pid)
+    for pid in pids:
+        os.waitpid(pid, 0)
+
+
+def kill_aggregator(socket_path):
+    result = subprocess.run(['fuser', socket_path + '.lock'], capture_output=True, text=True)
+    for pid in result.stdout.split():
+        os.kill(int(pid), signal.SIGKILL)
+
+
+def run(mode):
+    socket_path = os.path.join(tempfile.mkdtemp(), 'aggregator.sock')
+    start = time.perf_counter()
+    # Like stdout in a container, the workers share a pipe.
+    process = subprocess.Popen(
+        [sys.executable, '-W', 'ignore', '-m', 'benchmarks.bench_aggregator', 'worker', mode, socket_path],
+        stdout=subprocess.PIPE)
+    chunks = []
+    reader = threading.Thread(target=lambda: chunks.extend(iter(lambda: process.stdout.read(65536), b'')))
+    reader.start()
+    process.wait()
+    elapsed = time.perf_counter() - start
+
+    if mode == 'aggregate':
+        # The aggregator keeps the pipe open. Wait for it to write
+        # what it got, then stop it.
+        size = -1
+        while size != len(chunks):
+            size = len(chunks)
+            time.sleep(0.5)
+        kill_aggregator(socket_path)
+    reader.join()
+    lines = b''.join(chunks).splitlines()
+
+    good, broken, pids = 0, 0, set()
+    for line in lines:
+        try:
+            record = json.loads(line)
+            good += 1
+            pids.add(record.get('worker_pid'))
+        except ValueError:
+            broken += 1
+    print('%-10s %5d of %d lines whole, %4d broken, %d worker pids, %.2f s' % (
+        mode, good, WORKERS * RECORDS, broken, len(pids - {None}), elapsed))
+
+
+def main():
+    if len(sys.argv) > 1 and sys.argv[1] == 'worker':
+        return worker(*sys.argv[2:])
+    for mode in ('sync', 'aggregate'):
+        run(mode)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,42 @@
+# -*- coding: utf-8 -*-
+"""
+Time and output size of ``JsonProcessorFormatter`` for a record with a
+huge payload, with and without size limits. Run from the repository root with
+
+    python -m benchmarks.bench_bounded_encoder
+"""
+import datetime
+import logging
+import time
+
+import structlog
+
+from gcpi.stackdriverlog.formatters import JsonProcessorFormatter
+
+LIMITS = {'max_bytes': 256 * 1024, 'max_depth': 4, 'max_items': 100, 'max_string_length': 1000}
+
+PAYLOAD = {'rows': [
+    {'id': i, 'name': 'n' * 500, 'tags': list(range(100)), 'created': datetime.date(2020, 1, 1)}
+    for i in range(50000)
+]}
+
+
+def format_huge_record(formatter):
+    record = logging.makeLogRecord({
+        'name': 'bench', 'levelname': 'INFO', 'levelno': logging.INFO, '_logger': None,
+        'msg': {'event': 'export', 'payload': PAYLOAD}})
+    start = time.perf_counter()
+    data = formatter.format_bytes(record)
+    return time.perf_counter() - start, len(data)
+
+
+def main():
+    renderer = structlog.dev.ConsoleRenderer(colors=False)
+    for name, formatter in (('unbounded', JsonProcessorFormatter(renderer)),
+                            ('bounded', JsonProcessorFormatter(renderer, **LIMITS))):
+        elapsed, size = format_huge_record(formatter)
+        print('%-10s %10.2f ms %12d bytes' % (name, elapsed * 1000, size))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,86 @@
+# -*- coding: utf-8 -*-
+"""
+Throughput of ``CloudLoggingHandler`` against a local stand-in for the
+Cloud Logging API, which also fails the first requests with 503 to check
+that batches are retried. Run from the repository root with
+
+    python -m benchmarks.bench_cloud_logging
+"""
+import gzip
+import http.server
+import json
+import logging
+import threading
+import time
+
+import structlog
+
+from gcpi.stackdriverlog.exporters import WRITE_PATH, CloudLoggingHandler
+from gcpi.stackdriverlog.formatters import JsonProcessorFormatter
+
+RECORDS = 50000
+FAILURES = 2
+
+
+class FakeLoggingAPI(http.server.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    entries = []
+    requests = 0
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers['Content-Length']))
+        if self.headers.get('Content-Encoding') == 'gzip':
+            body = gzip.decompress(body)
+
+        FakeLoggingAPI.requests += 1
+        if self.path != WRITE_PATH or FakeLoggingAPI.requests <= FAILURES:
+            status = 404 if self.path != WRITE_PATH else 503
+            self.send_response(status)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+
+        FakeLoggingAPI.entries.extend(json.loads(body)['entries'])
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', '2')
+        self.end_headers()
+        self.wfile.write(b'{}')
+
+    def log_message(self, *args):
+        pass
+
+
+def main():
+    server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), FakeLoggingAPI)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+
+    handler = CloudLoggingHandler(
+        project='test-project', endpoint='http://127.0.0.1:%d' % server.server_port, token='test-token',
+        queue_size=RECORDS, backoff=0.01)
+    handler.setFormatter(JsonProcessorFormatter(structlog.dev.ConsoleRenderer(colors=False)))
+    logger = logging.getLogger('bench.cloud_logging')
+    logger.addHandler(handler)
+    logger.setLevel(logging.INFO)
+    logger.propagate = False
+
+    start = time.perf_counter()
+    for i in range(RECORDS):
+        logger.info('Invoice %s rendered', i)
+    queued = time.perf_counter() - start
+    handler.flush()
+    sent = time.perf_counter() - start
+    handler.close()
+    server.shutdown()
+
+    print('%d records queued in %.3f s (%.2f us per record)' % (RECORDS, queued, queued / RECORDS * 1e6))
+    print('sent in %.3f s (%.0f records/s) with %d requests' % (sent, RECORDS / sent, FakeLoggingAPI.requests))
+    print('sent %d, dropped %d, failed %d' % (handler.sent, handler.dropped, handler.failed))
+
+    assert len(FakeLoggingAPI.entries) == RECORDS, len(FakeLoggingAPI.entries)
+    entry = FakeLoggingAPI.entries[-1]
+    assert entry['severity'] == 'INFO' and entry['jsonPayload']['message'] == 'Invoice %d rendered' % (RECORDS - 1), entry
+
+
+if __name__ == '__main__':
+    main()
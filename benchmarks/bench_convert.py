@@ -0,0 +1,55 @@
+# -*- coding: utf-8 -*-
+"""
+Throughput of ``gcpi.stackdriverlog.convert`` on a generated file of mixed
+plain text and JSON lines, in this process and with a pool of workers,
+with plain and gzip compressed output. Run from the repository root with
+
+    python -m benchmarks.bench_convert
+"""
+import io
+import json
+import os
+import tempfile
+import time
+
+from gcpi.stackdriverlog import convert
+
+LINES = 200000
+
+
+def write_input(path):
+    with open(path, 'w') as f:
+        for i in range(LINES):
+            if i % 2:
+                f.write('2020-01-02 03:04:%02d,%03d ERROR app.views: request %d failed\n' % (i % 60, i % 1000, i))
+            else:
+                f.write(json.dumps({'level': 'info', 'msg': 'job %d' % i, 'time': '2021-05-06T07:08:09Z', 'seq': i}))
+                f.write('\n')
+
+
+class NullOutput(io.RawIOBase):
+    def writable(self):
+        return True
+
+    def write(self, data):
+        return len(data)
+
+
+def main():
+    path = os.path.join(tempfile.mkdtemp(), 'input.log')
+    write_input(path)
+    size = os.path.getsize(path) / 1e6
+    print('%d lines, %.1f MB, %d CPUs' % (LINES, size, os.cpu_count()))
+    for workers in (0, None):
+        for compresslevel in (None, 6):
+            start = time.perf_counter()
+            convert.convert([path], NullOutput(), workers=workers, compresslevel=compresslevel)
+            elapsed = time.perf_counter() - start
+            print('workers %-4s gzip %-5s %6.2f s %8.0f lines/s %6.1f MB/s' % (
+                workers if workers is not None else 'cpus', compresslevel is not None, elapsed,
+                LINES / elapsed, size / elapsed))
+    os.unlink(path)
+
+
+if __name__ == '__main__':
+    main()
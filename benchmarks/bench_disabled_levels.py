@@ -0,0 +1,62 @@
+# -*- coding: utf-8 -*-
+"""
+Cost of a ``debug()`` call when DEBUG is disabled, compared to an empty
+function call and to a plain ``structlog.stdlib.BoundLogger``.
+
+Run from the repository root with
+
+    python -m benchmarks.bench_disabled_levels
+"""
+import copy
+import logging
+import os
+import timeit
+
+import structlog
+
+from gcpi.stackdriverlog import conf, get_logger
+from gcpi.stackdriverlog.levels import set_level
+
+
+def empty(event=None, *args, **kw):
+    return None
+
+
+def per_call_ns(fn, number):
+    return min(timeit.Timer(fn).repeat(repeat=5, number=number)) / number * 1e9
+
+
+def main(number=200000):
+    config = copy.deepcopy(conf.DEFAULTS['LOGGING'])
+    config['disable_existing_loggers'] = False
+    config['handlers']['console']['stream'] = open(os.devnull, 'w')
+    conf.init({'LOGGING': config})
+
+    proxy = get_logger()
+    bound = structlog.get_logger('bench').bind()
+    unfiltered = structlog.stdlib.BoundLogger(
+        bound._logger, structlog.get_config()['processors'], {})
+
+    results = [
+        ('empty function call', lambda: empty('debug message', key='value')),
+        ('bound logger debug()', lambda: bound.debug('debug message', key='value')),
+        ('get_logger() proxy debug()', lambda: proxy.debug('debug message', key='value')),
+        ('structlog.stdlib.BoundLogger debug()', lambda: unfiltered.debug('debug message', key='value')),
+    ]
+    print('%-40s %10s' % ('call', 'ns'))
+    for name, fn in results:
+        print('%-40s %10.1f' % (name, per_call_ns(fn, number)))
+
+    # Enabling DEBUG at runtime turns the method back on for existing loggers.
+    set_level('DEBUG')
+    assert bound.debug.__func__ is structlog.stdlib.BoundLogger.debug
+    set_level('INFO')
+    # So does setting the level straight on a stdlib logger.
+    logging.getLogger('bench').setLevel(logging.DEBUG)
+    assert bound.debug.__func__ is structlog.stdlib.BoundLogger.debug
+    logging.getLogger('bench').setLevel(logging.NOTSET)
+    assert bound.debug.__func__ is not structlog.stdlib.BoundLogger.debug
+
+
+if __name__ == '__main__':
+    main()
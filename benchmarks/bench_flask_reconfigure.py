@@ -0,0 +1,58 @@
+# -*- coding: utf-8 -*-
+"""
+Counts ``logging.config.dictConfig`` calls made by the Flask integration
+over 10k simulated requests, and fails if the logging config is reloaded
+for anything but an actual change of the app's ``LOGGING`` config.
+
+Run from the repository root with
+
+    python -m benchmarks.bench_flask_reconfigure
+"""
+import copy
+import logging.config
+import time
+from unittest import mock
+
+import flask
+
+from gcpi.stackdriverlog import conf
+from gcpi.stackdriverlog.contrib import flask as flask_support
+
+
+def simulate_requests(app, count):
+    for _ in range(count):
+        with app.app_context():
+            pass
+
+
+def main(requests=10000):
+    app = flask.Flask(__name__)
+    app.config['LOGGING'] = copy.deepcopy(conf.DEFAULTS['LOGGING'])
+
+    with mock.patch.object(logging.config, 'dictConfig', wraps=logging.config.dictConfig) as dict_config:
+        start = time.perf_counter()
+        simulate_requests(app, requests)
+        elapsed = time.perf_counter() - start
+        print('%d requests: %d dictConfig calls, %.1f us per request'
+              % (requests, dict_config.call_count, elapsed / requests * 1e6))
+        assert dict_config.call_count == 1, dict_config.call_count
+
+        # Replacing the config with a different one reloads it once.
+        app.config['LOGGING'] = copy.deepcopy(app.config['LOGGING'])
+        app.config['LOGGING']['root']['level'] = 'DEBUG'
+        simulate_requests(app, requests)
+        print('after changing LOGGING: %d dictConfig calls' % dict_config.call_count)
+        assert dict_config.call_count == 2, dict_config.call_count
+
+        # A second app with the same config doesn't reload it.
+        other = flask.Flask(__name__)
+        other.config['LOGGING'] = app.config['LOGGING']
+        simulate_requests(other, requests)
+        simulate_requests(app, requests)
+        assert dict_config.call_count == 2, dict_config.call_count
+
+    assert flask_support.signals_available
+
+
+if __name__ == '__main__':
+    main()
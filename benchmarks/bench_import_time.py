@@ -0,0 +1,66 @@
+# -*- coding: utf-8 -*-
+"""
+Import time of ``gcpi.stackdriverlog.conf``, measured with
+``python -X importtime`` in fresh interpreters. Fails if importing it
+imports a web framework or configures logging, or if it takes longer
+than ``--max-ms``. Run from the repository root with
+
+    python -m benchmarks.bench_import_time --max-ms 250
+"""
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+
+MODULE = 'gcpi.stackdriverlog.conf'
+
+# Must not be imported by importing MODULE.
+FORBIDDEN_MODULES = ('django', 'flask', 'gcpi.stackdriverlog.instrumentation', 'gcpi.stackdriverlog.exporters')
+
+CHECK = f'''
+import logging, sys, structlog
+import {MODULE} as conf
+imported = [name for name in {FORBIDDEN_MODULES!r} if name in sys.modules]
+assert not imported, 'imported %s' % imported
+assert not conf.settings.configured, 'settings loaded'
+assert not logging.root.handlers, 'logging configured'
+'''
+
+
+def import_times(module):
+    """
+    Returns the cumulative import time of ``module`` and of each module
+    it imported first, in microseconds, from a fresh interpreter.
+    """
+    result = subprocess.run(
+        [sys.executable, '-X', 'importtime', '-c', f'import {module}'],
+        capture_output=True, text=True, check=True, env=dict(os.environ, PYTHONDONTWRITEBYTECODE='1'))
+    times = {}
+    for line in result.stderr.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        _, self_us, cumulative_us, name = (part.strip() for part in line.replace('import time:', '|').split('|'))
+        times[name] = int(cumulative_us)
+    return times
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--runs', type=int, default=10)
+    parser.add_argument('--max-ms', type=float, help='fail if the median import time is above this')
+    args = parser.parse_args(argv)
+
+    subprocess.run([sys.executable, '-c', CHECK], check=True)
+
+    runs = [import_times(MODULE) for _ in range(args.runs)]
+    total = statistics.median(run[MODULE] for run in runs) / 1000
+    structlog_ms = statistics.median(run.get('structlog', 0) for run in runs) / 1000
+    print('import %s: %.1f ms median of %d runs, %.1f ms of which structlog' % (MODULE, total, args.runs, structlog_ms))
+
+    if args.max_ms is not None and total > args.max_ms:
+        sys.exit('import time %.1f ms is above %.1f ms' % (total, args.max_ms))
+
+
+if __name__ == '__main__':
+    main()
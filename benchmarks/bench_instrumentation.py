@@ -0,0 +1,48 @@
+# -*- coding: utf-8 -*-
+"""
+Cost of logging through the ``conf.Settings`` chain with instrumentation
+disabled and enabled, and the counters it collected. Run from the
+repository root with
+
+    python -m benchmarks.bench_instrumentation
+"""
+import timeit
+
+import structlog
+
+import gcpi.stackdriverlog
+from benchmarks.suite import configure
+from gcpi.stackdriverlog import instrumentation
+
+NUMBER = 50000
+REPEAT = 7
+
+
+def best_ns(statement):
+    return min(timeit.repeat(statement, number=NUMBER, repeat=REPEAT)) / NUMBER * 1e9
+
+
+def main():
+    for native in (False, True):
+        configure(NATIVE_RENDERING=native)
+        log = structlog.get_logger('bench').bind()
+
+        def log_info():
+            log.info('Invoice rendered', invoice=1234, lines=5)
+
+        instrumentation.disable()
+        disabled = best_ns(log_info)
+        instrumentation.enable()
+        instrumentation.counters.reset()
+        enabled = best_ns(log_info)
+        stats = gcpi.stackdriverlog.stats()
+        instrumentation.disable()
+
+        mode = 'native' if native else 'json'
+        print('%-8s disabled %8.1f ns   enabled %8.1f ns   (%+.1f%%)' % (
+            mode, disabled, enabled, (enabled - disabled) / disabled * 100))
+        print('         %s' % stats)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,80 @@
+# -*- coding: utf-8 -*-
+"""
+Cost of ``RedactionProcessor`` per event, for a typical event dict and one
+with a nested payload, with key names only and with value patterns too, with and without
+the cache of strings searched.
+Run from the repository root with
+
+    python -m benchmarks.bench_redaction
+"""
+import timeit
+
+from benchmarks.suite import PAYLOAD
+from gcpi.stackdriverlog.conf import DEFAULTS
+from gcpi.stackdriverlog.processors import TRACE_KEY, RedactionProcessor
+
+NUMBER = 50000
+REPEAT = 7
+
+EVENTS = {
+    'typical': {
+        'event': 'Invoice rendered', 'logger': 'bench', 'level': 'info', TRACE_KEY: 'projects/p/traces/abc',
+        'request_id': 'f3a9c2', 'invoice': 1234, 'lines': 5, 'customer_email': 'someone@example.com',
+    },
+    'nested payload': {'event': 'Invoice rendered', 'logger': 'bench', 'level': 'info', 'payload': PAYLOAD},
+    'with secrets': {
+        'event': 'Login', 'logger': 'bench', 'level': 'info', 'token': 'abc',
+        'headers': {'Authorization': 'Bearer abc.def', 'Accept': 'application/json'},
+    },
+}
+
+
+# Keys redacted with the default LOG_REDACTED_KEYS, and keys kept.
+REDACTED_KEYS = (
+    'password', 'Password', 'access_token', 'X-Token', 'accessToken', 'refreshToken', 'clientSecret',
+    'userPassword', 'HTTPAuthorization', 'tokens', 'auth_tokens', 'passwords',
+)
+KEPT_KEYS = ('tokenizer', 'secretary', 'passport')
+
+
+def check(processor):
+    """
+    Fails if a sensitive key of the default config is logged in clear.
+    """
+    event_dict = processor(None, 'info', {key: 'secret value' for key in REDACTED_KEYS + KEPT_KEYS})
+    leaked = [key for key in REDACTED_KEYS if event_dict[key] != processor.replacement]
+    assert not leaked, leaked
+    redacted = [key for key in KEPT_KEYS if event_dict[key] == processor.replacement]
+    assert not redacted, redacted
+
+    # Numbers and flags of keys merely containing a sensitive word are kept.
+    event_dict = processor(None, 'info', {'token_count': 3, 'password_reset_enabled': True, 'tokens': 3})
+    assert event_dict == {'token_count': 3, 'password_reset_enabled': True, 'tokens': processor.replacement}
+
+
+def best_ns(processor, event_dict):
+    # The processor changes the top-level dict, so it gets a fresh copy each time.
+    def run():
+        processor(None, 'info', dict(event_dict))
+    copying = min(timeit.repeat(lambda: dict(event_dict), number=NUMBER, repeat=REPEAT))
+    return (min(timeit.repeat(run, number=NUMBER, repeat=REPEAT)) - copying) / NUMBER * 1e9
+
+
+def main():
+    processors = (
+        ('keys', RedactionProcessor(keys=DEFAULTS['LOG_REDACTED_KEYS'])),
+        ('keys + email, bearer, card', RedactionProcessor(
+            keys=DEFAULTS['LOG_REDACTED_KEYS'], values=['email', 'bearer', 'card'])),
+        # As if every string was seen for the first time.
+        ('same, strings not cached', RedactionProcessor(
+            keys=DEFAULTS['LOG_REDACTED_KEYS'], values=['email', 'bearer', 'card'], max_cached_length=-1)),
+    )
+    print('%-30s %-16s %8s' % ('redaction', 'event', 'ns'))
+    for name, processor in processors:
+        check(processor)
+        for event, event_dict in EVENTS.items():
+            print('%-30s %-16s %8.1f' % (name, event, best_ns(processor, event_dict)))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,68 @@
+# -*- coding: utf-8 -*-
+"""
+Helpers to time a callable and record its allocations.
+"""
+import gc
+import time
+import tracemalloc
+
+
+def percentile(sorted_values, share):
+    index = min(len(sorted_values) - 1, int(len(sorted_values) * share))
+    return sorted_values[index]
+
+
+def measure(name, fn, iterations=20000, warmup=1000, alloc_iterations=500):
+    """
+    Runs ``fn`` and returns its throughput, latency percentiles and the
+    memory allocated per call.
+
+    Throughput is taken from a tight loop, latencies from timing each
+    call separately, and allocations from the tracemalloc peak of each call.
+    """
+    for _ in range(warmup):
+        fn()
+
+    gc.collect()
+    start = time.perf_counter()
+    for _ in range(iterations):
+        fn()
+    elapsed = time.perf_counter() - start
+
+    perf_counter_ns = time.perf_counter_ns
+    latencies = []
+    for _ in range(iterations):
+        call_start = perf_counter_ns()
+        fn()
+        latencies.append(perf_counter_ns() - call_start)
+    latencies.sort()
+
+    allocations = []
+    tracemalloc.start()
+    try:
+        for _ in range(alloc_iterations):
+            tracemalloc.reset_peak()
+            current = tracemalloc.get_traced_memory()[0]
+            fn()
+            allocations.append(tracemalloc.get_traced_memory()[1] - current)
+    finally:
+        tracemalloc.stop()
+    allocations.sort()
+
+    return {
+        'name': name,
+        'iterations': iterations,
+        'throughput_per_s': round(iterations / elapsed, 1),
+        'mean_us': round(elapsed / iterations * 1e6, 3),
+        'p50_us': round(percentile(latencies, 0.50) / 1000, 3),
+        'p99_us': round(percentile(latencies, 0.99) / 1000, 3),
+        'alloc_bytes_per_call': percentile(allocations, 0.50),
+    }
+
+
+def print_results(results):
+    print('%-48s %12s %10s %10s %10s %12s' % ('benchmark', 'calls/s', 'mean us', 'p50 us', 'p99 us', 'alloc bytes'))
+    for result in results:
+        print('%-48s %12.0f %10.2f %10.2f %10.2f %12d' % (
+            result['name'], result['throughput_per_s'], result['mean_us'],
+            result['p50_us'], result['p99_us'], result['alloc_bytes_per_call']))
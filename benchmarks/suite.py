@@ -0,0 +1,204 @@
+# -*- coding: utf-8 -*-
+"""
+Logging overhead of every shipped entry point: ``get_logger()``,
+``StackDriverLogger``, the ``conf.Settings`` processor chain with
+``JsonProcessorFormatter``, and the Django request logging middleware.
+
+All output goes to ``os.devnull``, so nothing but the logging
+itself is measured. Run from the repository root with
+
+    python -m benchmarks.suite --output results.json
+    python -m benchmarks.suite --compare results.json
+
+The results of a previous run can be compared with ``--compare``.
+"""
+import argparse
+import copy
+import datetime
+import json
+import logging
+import os
+import platform
+import sys
+
+from benchmarks.harness import measure, print_results
+
+try:
+    import django
+    from django.conf import settings as django_settings
+except ImportError:
+    django = None
+
+# Django must be configured before the settings are imported.
+if django is not None and not django_settings.configured:
+    django_settings.configure(
+        DEBUG=False,
+        ALLOWED_HOSTS=['*'],
+        ROOT_URLCONF=__name__,
+        MIDDLEWARE=['gcpi.stackdriverlog.contrib.django.middleware.RequestLoggingMiddleware'],
+        LOGGING_CONFIG=None,
+        STACK_DRIVER_LOGGER={},
+    )
+    django.setup()
+
+import structlog
+
+import gcpi.stackdriverlog
+from gcpi.stackdriverlog import conf
+from gcpi.stackdriverlog.formatters import JsonProcessorFormatter
+
+NULL_STREAM = open(os.devnull, 'w', encoding='utf-8')
+
+PAYLOAD = {'invoice': 1234, 'lines': [{'sku': 'A-1', 'amount': 10.5}] * 5, 'customer': {'name': 'Test', 'vip': True}}
+
+
+def null_logging_config():
+    config = copy.deepcopy(conf.DEFAULTS['LOGGING'])
+    config['disable_existing_loggers'] = False
+    config['handlers']['console']['stream'] = NULL_STREAM
+    return config
+
+
+def configure(**user_settings):
+    user_settings.setdefault('LOGGING', null_logging_config())
+    conf.init(user_settings)
+
+
+def bench_entry_points(options):
+    configure()
+    return [
+        measure('get_logger()', gcpi.stackdriverlog.get_logger, **options),
+    ]
+
+
+def bench_settings_chain(options, native):
+    mode = 'native' if native else 'json'
+    configure(NATIVE_RENDERING=native)
+    log = structlog.get_logger('bench')
+
+    def log_exception():
+        try:
+            raise ValueError('boom')
+        except ValueError:
+            log.exception('failed')
+
+    return [
+        measure(f'{mode}: plain message', lambda: log.info('plain message'), **options),
+        measure(f'{mode}: dict payload',
+                lambda: log.info(PAYLOAD, message='Invoice render timing', param1='true'), **options),
+        measure(f'{mode}: exception', log_exception, **options),
+        measure(f'{mode}: filtered debug', lambda: log.debug('filtered'), **options),
+        measure(f'{mode}: stdlib logging', lambda: logging.getLogger('bench').info('plain %s', 'message'), **options),
+    ]
+
+
+def bench_formatter(options):
+    formatter = JsonProcessorFormatter(structlog.dev.ConsoleRenderer(colors=False))
+    record = logging.makeLogRecord({
+        'name': 'bench', 'levelname': 'INFO', 'levelno': logging.INFO, 'msg': 'plain message', 'param1': 'true'})
+
+    def format_record():
+        record.msg, record.args = 'plain message', ()
+        return formatter.format(record)
+
+    return [
+        measure('JsonProcessorFormatter.format', format_record, **options),
+    ]
+
+
+def bench_django(options):
+    if django is None:
+        print('Django is not installed, skipping the middleware benchmarks.', file=sys.stderr)
+        return []
+
+    from django.test import Client
+
+    results = []
+    for native in (False, True):
+        configure(NATIVE_RENDERING=native)
+        client = Client()
+        mode = 'native' if native else 'json'
+        results += [
+            measure(f'{mode}: middleware GET', lambda: client.get('/bench', {'page': 1}), **options),
+            measure(f'{mode}: middleware POST json',
+                    lambda: client.post('/bench', PAYLOAD, content_type='application/json'), **options),
+            measure(f'{mode}: middleware ignored path', lambda: client.get('/health'), **options),
+        ]
+    return results
+
+
+def bench_stackdriver_logger(options):
+    # StackDriverLogger configures logging and structlog by itself, so it goes last.
+    from gcpi.stackdriverlog.loggers import StackDriverLogger
+
+    hook = sys.excepthook
+    try:
+        stackdriver_logger = StackDriverLogger(config=null_logging_config())
+    finally:
+        sys.excepthook = hook
+
+    return [
+        measure('StackDriverLogger.get_logger', lambda: stackdriver_logger.get_logger('bench'), **options),
+    ]
+
+
+def view(request):
+    from django.http import HttpResponse
+    return HttpResponse('ok')
+
+
+if django is not None:
+    from django.urls import path
+    urlpatterns = [path('bench', view), path('health', view)]
+
+
+def compare(results, previous):
+    previous = {result['name']: result for result in previous['results']}
+    print('\n%-48s %12s %12s %8s' % ('benchmark', 'before us', 'after us', 'change'))
+    for result in results:
+        before = previous.get(result['name'])
+        if before is None:
+            continue
+        change = (result['mean_us'] - before['mean_us']) / before['mean_us'] * 100
+        print('%-48s %12.2f %12.2f %+7.1f%%' % (result['name'], before['mean_us'], result['mean_us'], change))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--output', help='write the results as JSON to this file')
+    parser.add_argument('--compare', help='compare to the JSON results of a previous run')
+    parser.add_argument('--iterations', type=int, default=20000)
+    args = parser.parse_args(argv)
+
+    options = {'iterations': args.iterations, 'warmup': max(1, args.iterations // 20)}
+    django_options = dict(options, iterations=max(1, args.iterations // 10))
+
+    results = bench_entry_points(options)
+    results += bench_settings_chain(options, native=False)
+    results += bench_settings_chain(options, native=True)
+    results += bench_formatter(options)
+    results += bench_django(django_options)
+    results += bench_stackdriver_logger(options)
+    print_results(results)
+
+    if args.compare:
+        with open(args.compare) as fh:
+            compare(results, json.load(fh))
+
+    if args.output:
+        with open(args.output, 'w') as fh:
+            json.dump({
+                'meta': {
+                    'date': datetime.datetime.now(datetime.timezone.utc).isoformat(),
+                    'python': platform.python_version(),
+                    'implementation': platform.python_implementation(),
+                    'platform': platform.platform(),
+                    'structlog': structlog.__version__,
+                    'django': django.get_version() if django is not None else None,
+                },
+                'results': results,
+            }, fh, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -8,4 +8,25 @@ def stackdriver_init_logging():
                              )
 
 def get_logger():
-    return structlog.get_logger()
\ No newline at end of file
+    # Importing the settings makes the returned logger load
+    # them and configure logging the first time it's used.
+    import gcpi.stackdriverlog.conf
+    return structlog.get_logger()
+
+
+def init(user_settings=None):
+    """
+    Load the settings and configure logging now, instead of
+    on the first use of a logger.
+    """
+    from gcpi.stackdriverlog.conf import init
+    return init(user_settings)
+
+
+def stats():
+    """
+    Returns counters of the records logged and the time spent logging them.
+    See ``gcpi.stackdriverlog.instrumentation``.
+    """
+    from gcpi.stackdriverlog.instrumentation import stats
+    return stats()
@@ -0,0 +1,344 @@
+# -*- coding: utf-8 -*-
+"""
+Aggregates the logs of prefork workers (gunicorn, uWSGI) in a single
+process, so that their lines never interleave on the shared stdout.
+
+Each worker sends batches of formatted records to the aggregator over a
+unix socket with ``AggregatorHandler``. The aggregator is the only one
+writing to stdout, and only ever writes whole batches, so every line is
+written whole. The first worker that can't connect starts the aggregator,
+and a lock file makes sure only one runs. It can also be started before
+the workers with
+
+    python -m gcpi.stackdriverlog.aggregator --socket /run/user/1000/gcpi-log-aggregator.sock
+
+The default socket is in a directory only the user can access, and
+both ends check that the other one runs as the same user, so that
+another local user can't receive the logs or send lines to them.
+"""
+import argparse
+import errno
+import fcntl
+import os
+import selectors
+import socket
+import stat
+import struct
+import subprocess
+import sys
+import tempfile
+import time
+
+from gcpi.stackdriverlog.handlers import AsyncStreamHandler
+
+# Frames are a 4 byte big-endian length followed by whole lines.
+FRAME_HEADER = struct.Struct('>I')
+
+# Process id, user id and group id of the peer of a unix socket.
+PEER_CREDENTIALS = struct.Struct('3i')
+
+
+def private_dir():
+    """
+    Returns a directory only the current user can access: ``$XDG_RUNTIME_DIR``,
+    or a ``gcpi-<uid>`` directory in the temporary directory, made if needed.
+    Raises ``PermissionError`` if that one belongs to someone else, or is
+    accessible by others.
+    """
+    uid = os.getuid()
+    runtime_dir = os.environ.get('XDG_RUNTIME_DIR')
+    if runtime_dir:
+        try:
+            st = os.lstat(runtime_dir)
+        except OSError:
+            pass
+        else:
+            if stat.S_ISDIR(st.st_mode) and st.st_uid == uid and not st.st_mode & 0o077:
+                return runtime_dir
+
+    path = os.path.join(tempfile.gettempdir(), 'gcpi-%d' % uid)
+    try:
+        os.mkdir(path, 0o700)
+    except FileExistsError:
+        pass
+    # Checked even when made above, as the mode is subject to the umask.
+    st = os.lstat(path)
+    if not stat.S_ISDIR(st.st_mode) or st.st_uid != uid or st.st_mode & 0o077:
+        raise PermissionError(errno.EACCES, 'Not a private directory of user %d' % uid, path)
+    return path
+
+
+def default_socket_path():
+    return os.path.join(private_dir(), 'gcpi-log-aggregator.sock')
+
+
+def same_user(sock):
+    """
+    Returns whether the process at the other end of the unix socket ``sock``
+    runs as the current user. Always True where ``SO_PEERCRED`` isn't available.
+    """
+    if not hasattr(socket, 'SO_PEERCRED'):
+        return True
+    creds = sock.getsockopt(socket.SOL_SOCKET, socket.SO_PEERCRED, PEER_CREDENTIALS.size)
+    _, uid, _ = PEER_CREDENTIALS.unpack(creds)
+    return uid == os.getuid()
+
+
+class AggregatorHandler(AsyncStreamHandler):
+    """
+    An ``AsyncStreamHandler`` that sends its batches to the aggregator
+    instead of writing them to the stream. Records get a ``worker_pid``.
+
+    The connection is made again in forked workers, and when the
+    aggregator has gone away. If the aggregator isn't running, it's
+    started, and the writer thread waits up to ``connect_timeout`` seconds
+    for it. If it still can't be reached, batches are written to the stream
+    for ``retry_interval`` seconds before trying again. They're always
+    written to the stream if there's no private directory for the default
+    socket, or if the aggregator runs as another user.
+    """
+    def __init__(self, stream=None, socket_path=None, spawn=True, connect_timeout=5.0, retry_interval=5.0,
+                 **kwargs):
+        if socket_path is None:
+            try:
+                socket_path = default_socket_path()
+            except OSError:
+                pass
+        self.socket_path = socket_path
+        self.spawn = spawn
+        self.connect_timeout = connect_timeout
+        self.retry_interval = retry_interval
+        self.pid = os.getpid()
+        self._socket = None
+        self._process = None
+        self._next_connect = 0.0
+        super(AggregatorHandler, self).__init__(stream, **kwargs)
+
+    def emit(self, record):
+        record.worker_pid = self.pid
+        super(AggregatorHandler, self).emit(record)
+
+    def binary_buffer(self):
+        # Batches are sent as bytes whenever the formatter can render them.
+        if getattr(self.formatter, 'format_bytes', None) is not None:
+            return self
+        return None
+
+    def write(self, data, buffer=None):
+        if isinstance(data, str):
+            data = data.encode('utf-8')
+        if self.send(data):
+            return
+        # Fall back to writing to the stream ourselves.
+        stream_buffer = super(AggregatorHandler, self).binary_buffer()
+        super(AggregatorHandler, self).write(
+            data if stream_buffer is not None else data.decode('utf-8'), stream_buffer)
+
+    def send(self, data):
+        """
+        Send a batch of lines to the aggregator. Returns False if it can't be reached.
+        """
+        for _ in range(2):
+            sock = self.connect()
+            if sock is None:
+                return False
+            try:
+                sock.sendall(FRAME_HEADER.pack(len(data)) + data)
+                return True
+            except OSError:
+                # The aggregator went away, try again with a new connection.
+                self.disconnect()
+                self._next_connect = 0.0
+        return False
+
+    def connect(self):
+        if self._socket is not None:
+            return self._socket
+        if self.socket_path is None:
+            return None
+
+        now = time.monotonic()
+        if now < self._next_connect:
+            return None
+
+        sock = self.try_connect()
+        if sock is None and self.spawn:
+            self.spawn_aggregator()
+            deadline = now + self.connect_timeout
+            while sock is None and time.monotonic() < deadline:
+                time.sleep(0.05)
+                sock = self.try_connect()
+
+        if sock is None:
+            self._next_connect = time.monotonic() + self.retry_interval
+        self._socket = sock
+        return sock
+
+    def try_connect(self):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            sock.connect(self.socket_path)
+            if not same_user(sock):
+                sock.close()
+                return None
+        except OSError:
+            sock.close()
+            return None
+        return sock
+
+    def disconnect(self):
+        if self._socket is not None:
+            self._socket.close()
+            self._socket = None
+
+    def spawn_aggregator(self):
+        """
+        Start an aggregator that writes to our stream, unless one
+        started by this process is still running.
+        """
+        if self._process is not None and self._process.poll() is None:
+            return
+        try:
+            stream_fd = self.stream.fileno()
+        except (AttributeError, OSError, ValueError):
+            stream_fd = None
+        self._process = subprocess.Popen(
+            [sys.executable, '-m', 'gcpi.stackdriverlog.aggregator', '--socket', self.socket_path],
+            stdin=subprocess.DEVNULL, stdout=stream_fd, start_new_session=True)
+
+    def close(self):
+        super(AggregatorHandler, self).close()
+        self.disconnect()
+
+    def _after_fork(self):
+        # The connection belongs to the parent. Closing our copy of it
+        # leaves it open in the parent, and we connect again when needed.
+        self.disconnect()
+        self._process = None
+        self._next_connect = 0.0
+        self.pid = os.getpid()
+        super(AggregatorHandler, self)._after_fork()
+
+
+def acquire_lock(socket_path):
+    """
+    Returns the open lock file of the aggregator for ``socket_path``,
+    or None if another aggregator holds it.
+    """
+    fd = os.open(socket_path + '.lock', os.O_WRONLY | os.O_APPEND | os.O_CREAT | os.O_NOFOLLOW, 0o600)
+    lock = os.fdopen(fd, 'a')
+    try:
+        fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except OSError as exc:
+        lock.close()
+        if exc.errno in (errno.EAGAIN, errno.EACCES):
+            return None
+        raise
+    return lock
+
+
+def serve(socket_path, stream, idle_timeout=None):
+    """
+    Accept connections on ``socket_path`` and write the lines received to
+    the binary ``stream``. Returns after ``idle_timeout`` seconds without
+    connections, if set.
+    """
+    if os.path.exists(socket_path):
+        # Left behind by an aggregator that's gone, as we hold the lock.
+        os.unlink(socket_path)
+
+    server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    server.bind(socket_path)
+    server.listen(128)
+    server.setblocking(False)
+
+    selector = selectors.DefaultSelector()
+    selector.register(server, selectors.EVENT_READ)
+    buffers = {}
+    idle_since = time.monotonic()
+    try:
+        while True:
+            lines = []
+            for key, _ in selector.select(timeout=1.0):
+                if key.fileobj is server:
+                    try:
+                        conn, _ = server.accept()
+                    except BlockingIOError:
+                        continue
+                    if not same_user(conn):
+                        conn.close()
+                        continue
+                    conn.setblocking(False)
+                    selector.register(conn, selectors.EVENT_READ)
+                    buffers[conn] = bytearray()
+                    continue
+
+                conn = key.fileobj
+                try:
+                    data = conn.recv(1 << 16)
+                except BlockingIOError:
+                    continue
+                except OSError:
+                    data = b''
+                if not data:
+                    # Frames cut short by a worker that died are dropped.
+                    selector.unregister(conn)
+                    conn.close()
+                    del buffers[conn]
+                    continue
+
+                buffer = buffers[conn]
+                buffer += data
+                lines.extend(read_frames(buffer))
+
+            if lines:
+                stream.write(b''.join(lines))
+                stream.flush()
+
+            if buffers:
+                idle_since = time.monotonic()
+            elif idle_timeout is not None and time.monotonic() - idle_since >= idle_timeout:
+                return
+    finally:
+        selector.close()
+        server.close()
+        for conn in buffers:
+            conn.close()
+        if os.path.exists(socket_path):
+            os.unlink(socket_path)
+
+
+def read_frames(buffer):
+    """
+    Removes the complete frames from the start of ``buffer`` and returns their payloads.
+    """
+    frames, offset = [], 0
+    size = FRAME_HEADER.size
+    while len(buffer) - offset >= size:
+        (length,) = FRAME_HEADER.unpack_from(buffer, offset)
+        if len(buffer) - offset - size < length:
+            break
+        frames.append(bytes(buffer[offset + size:offset + size + length]))
+        offset += size + length
+    del buffer[:offset]
+    return frames
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Write the logs sent by AggregatorHandler to stdout.')
+    parser.add_argument('--socket', help='unix socket to listen on, by default in a directory private to the user')
+    parser.add_argument('--idle-timeout', type=float, default=60.0,
+                        help='exit after this many seconds without workers, 0 to never exit')
+    args = parser.parse_args(argv)
+    socket_path = args.socket or default_socket_path()
+
+    lock = acquire_lock(socket_path)
+    if lock is None:
+        # Another aggregator is running.
+        return
+    with lock:
+        serve(socket_path, sys.stdout.buffer, args.idle_timeout or None)
+
+
+if __name__ == '__main__':
+    main()
@@ -19,31 +19,49 @@ STACK_DRIVER_LOGGER = {
         ...
     }
 }
+
+Nothing is configured when this module is imported. The settings are
+loaded and logging is configured on the first use of a structlog
+logger, the first access to ``settings``, or when :func:`init` is called.
 """
 import collections
 import logging.config
+import sys
+import threading
 
 import structlog
 
 from gcpi.stackdriverlog.contrib import compat
 from gcpi.stackdriverlog.formatters import JsonProcessorFormatter
+from gcpi.stackdriverlog.levels import FilteringBoundLogger, install_level_hook, update_min_level
+from gcpi.stackdriverlog.processors import (
+    RedactionProcessor, SamplingProcessor, TraceContextProcessor, format_exc_info,
+)
+
 
+def read_user_settings():
+    """
+    Returns the STACK_DRIVER_LOGGER setting of Django, if it's installed,
+    with the LOGGING setting of Django unless it has its own.
+    """
+    if not compat.django_support:
+        return None
 
-USER_SETTINGS = None
-if compat.django_support:
     from django.core.exceptions import ImproperlyConfigured
     try:
         from django.conf import settings
-        USER_SETTINGS = getattr(settings, 'STACK_DRIVER_LOGGER', {})
+        user_settings = dict(getattr(settings, 'STACK_DRIVER_LOGGER', {}))
 
-        if 'LOGGING' not in USER_SETTINGS and settings.LOGGING:
-            USER_SETTINGS['LOGGING'] = settings.LOGGING
+        if 'LOGGING' not in user_settings and settings.LOGGING:
+            user_settings['LOGGING'] = settings.LOGGING
+        return user_settings
     except ImproperlyConfigured:
         # Might trigger if Django is installed, but not properly set ut.
         # We don't want to break here as we could potentially be running
         # from a shell script or other things that want to log.
         import warnings
         warnings.warn('Django is installed, but not properly set up!')
+        return None
 
 
 DEFAULTS = {
@@ -52,9 +70,19 @@ DEFAULTS = {
     'REQUEST_MIDDLEWARE_IGNORE_PATHS': [
         r'^/health/?$'
     ],
+
+    # Regular expressions of paths mapped to the share of their requests
+    # that should be logged by the logging middleware, from 0.0 to 1.0.
+    # The first matching pattern is used (Django only for now).
+    'REQUEST_MIDDLEWARE_SAMPLING_RATES': {},
     
     'LOG_REQUEST_ID_HEADER': 'HTTP_X_REQUEST_ID',
 
+    # Project the traces of incoming requests belong to, to correlate log
+    # entries with Cloud Trace. Defaults to the GOOGLE_CLOUD_PROJECT
+    # environment variable.
+    'TRACE_PROJECT': None,
+
     # List of json keys in request body that should not be
     # logged by the logging middleware (Django only for now)
     'REQUEST_MIDDLEWARE_SENSITIVE_POST_PARAMETERS': ['password', 'token'],
@@ -62,9 +90,88 @@ DEFAULTS = {
     # Truncate and log body as string if body is too long
     'REQUEST_MIDDLEWARE_BODY_MAX_LENGTH': 500,
 
+    # If set True, the logging middleware keeps latency histograms per
+    # (route, method, status) in ``gcpi.stackdriverlog.metrics.request_latency``,
+    # and logs their percentiles every REQUEST_MIDDLEWARE_LATENCY_SNAPSHOT_INTERVAL
+    # seconds, if set (Django only for now).
+    'REQUEST_MIDDLEWARE_LATENCY_HISTOGRAMS': True,
+    'REQUEST_MIDDLEWARE_LATENCY_SNAPSHOT_INTERVAL': None,
+
+    # If set True, the logging middleware adds the number of database
+    # queries, the time spent in them, the number of duplicate queries and
+    # the REQUEST_MIDDLEWARE_QUERY_STATS_SLOWEST slowest ones, per database
+    # alias, to the request log record (Django only, in sync mode).
+    'REQUEST_MIDDLEWARE_QUERY_STATS': False,
+    'REQUEST_MIDDLEWARE_QUERY_STATS_SLOWEST': 5,
+
+    # Seconds after which the logging middleware adds a profile of the
+    # request to its log record, or None to not profile requests. The stack
+    # of requests is sampled every REQUEST_MIDDLEWARE_PROFILE_INTERVAL
+    # seconds, for at most REQUEST_MIDDLEWARE_PROFILE_MAX_CONCURRENT requests
+    # at once (Django only, in sync mode).
+    'REQUEST_MIDDLEWARE_PROFILE_THRESHOLD': None,
+    'REQUEST_MIDDLEWARE_PROFILE_INTERVAL': 0.005,
+    'REQUEST_MIDDLEWARE_PROFILE_MAX_CONCURRENT': 4,
+
     # If set True, force settings all log levels to DEBUG.
     'FORCE_DEBUG_LEVEL': False,
 
+    # If set True, structlog hands the event dictionary straight to the
+    # formatter instead of rendering it to JSON first. Every handler must
+    # then use a ``structlog.stdlib.ProcessorFormatter`` based formatter,
+    # like ``JsonProcessorFormatter``.
+    'NATIVE_RENDERING': False,
+
+    # Logger names or level names mapped to the share of their
+    # events to log, from 0.0 to 1.0. E.g. {'debug': 0.1}.
+    'LOG_SAMPLING_RATES': {},
+
+    # Max events per second logged for each (logger, event) pair, and the
+    # burst allowed. The number of suppressed events is logged every
+    # LOG_SUPPRESSED_SUMMARY_INTERVAL seconds.
+    'LOG_RATE_LIMIT': None,
+    'LOG_RATE_LIMIT_BURST': None,
+    'LOG_SUPPRESSED_SUMMARY_INTERVAL': 60,
+
+    # Keys whose values are redacted from every event, at any depth. Keys
+    # are matched case insensitively on the words they're made of, so
+    # 'token' also matches 'access_token', 'accessToken', 'X-Token' and
+    # 'auth_tokens', whose values are only redacted if they're strings.
+    # Set to [] to turn redaction off.
+    'LOG_REDACTED_KEYS': ['password', 'token', 'secret', 'authorization'],
+
+    # Values redacted from every string logged: any of 'email', 'bearer'
+    # and 'card', or regular expressions. E.g. ['email', 'card'].
+    'LOG_REDACTED_VALUES': [],
+
+    # What redacted keys and values are replaced with.
+    'LOG_REDACTION_REPLACEMENT': 'xxxxxxxx (removed)',
+
+    # Set to 'async' to have stream handlers write from a background thread,
+    # so that logging never waits on a full stdout pipe. Set to 'aggregate'
+    # to also have them send their records to a single aggregator process
+    # writing for all prefork workers, see ``gcpi.stackdriverlog.aggregator``.
+    'HANDLER_MODE': 'sync',
+
+    # Max number of records waiting to be written in async mode, and what to
+    # do when the queue is full: 'drop' the record or 'block' until there's room.
+    'ASYNC_HANDLER_QUEUE_SIZE': 10000,
+    'ASYNC_HANDLER_OVERFLOW': 'drop',
+
+    # Max number of records written at once in async mode.
+    'ASYNC_HANDLER_BATCH_SIZE': 256,
+
+    # Unix socket of the aggregator in aggregate mode. Defaults to a socket
+    # in $XDG_RUNTIME_DIR, or in a gcpi-<uid> directory private to the user
+    # in the temporary directory.
+    'AGGREGATOR_SOCKET': None,
+
+    # If set True, count records, bytes and the time spent in processors,
+    # serialization and writing, see ``gcpi.stackdriverlog.stats()``. The
+    # counters are logged every INSTRUMENTATION_REPORT_INTERVAL seconds, if set.
+    'INSTRUMENTATION': False,
+    'INSTRUMENTATION_REPORT_INTERVAL': None,
+
     # Python logging dict config
     'LOGGING': {
         'version': 1,
@@ -82,7 +189,7 @@ DEFAULTS = {
         'handlers': {
             'console': {
                 'level': 'INFO',
-                'class': 'logging.StreamHandler',
+                'class': 'gcpi.stackdriverlog.handlers.StreamHandler',
                 'formatter': 'json'
             },
         }
@@ -90,6 +197,11 @@ DEFAULTS = {
 }
 
 
+# Handler classes replaced by ``AsyncStreamHandler`` when HANDLER_MODE is 'async',
+# and by ``AggregatorHandler`` when it's 'aggregate'.
+STREAM_HANDLER_CLASSES = ('logging.StreamHandler', 'gcpi.stackdriverlog.handlers.StreamHandler')
+
+
 class Settings:
     def __init__(self, user_settings=None, defaults=None):
         if user_settings:
@@ -98,20 +210,42 @@ class Settings:
 
         # Setup logging.
         # Defaults taken from structlog documentation.
+        processors = [structlog.stdlib.filter_by_level]
+        if self.LOG_SAMPLING_RATES or self.LOG_RATE_LIMIT is not None:
+            # Drop events before any work is spent on them.
+            processors.append(SamplingProcessor(
+                rates=self.LOG_SAMPLING_RATES,
+                rate_limit=self.LOG_RATE_LIMIT,
+                burst=self.LOG_RATE_LIMIT_BURST,
+                summary_interval=self.LOG_SUPPRESSED_SUMMARY_INTERVAL,
+            ))
+        processors += [
+            structlog.stdlib.add_logger_name,
+            structlog.stdlib.add_log_level,
+            TraceContextProcessor(self.TRACE_PROJECT),
+            structlog.stdlib.PositionalArgumentsFormatter(),
+            structlog.processors.StackInfoRenderer(),
+            format_exc_info,
+            structlog.processors.UnicodeDecoder(),
+        ]
+        if self.LOG_REDACTED_KEYS or self.LOG_REDACTED_VALUES:
+            processors.append(RedactionProcessor(
+                keys=self.LOG_REDACTED_KEYS,
+                values=self.LOG_REDACTED_VALUES,
+                replacement=self.LOG_REDACTION_REPLACEMENT,
+            ))
+        if self.NATIVE_RENDERING is True:
+            # Let the formatter serialize the event dict once, instead of
+            # rendering it to JSON here and parsing it again in the formatter.
+            processors.append(structlog.stdlib.ProcessorFormatter.wrap_for_formatter)
+        else:
+            processors.append(structlog.processors.JSONRenderer())
+
         structlog.configure(
-            processors=[
-                structlog.stdlib.filter_by_level,
-                structlog.stdlib.add_logger_name,
-                structlog.stdlib.add_log_level,
-                structlog.stdlib.PositionalArgumentsFormatter(),
-                structlog.processors.StackInfoRenderer(),
-                structlog.processors.format_exc_info,
-                structlog.processors.UnicodeDecoder(),
-                structlog.processors.JSONRenderer()
-            ],
+            processors=processors,
             context_class=dict,
-            logger_factory=structlog.stdlib.LoggerFactory(),
-            wrapper_class=structlog.stdlib.BoundLogger,
+            logger_factory=structlog.stdlib.LoggerFactory(ignore_frame_names=[__name__]),
+            wrapper_class=FilteringBoundLogger,
             cache_logger_on_first_use=True,
         )
 
@@ -120,7 +254,20 @@ class Settings:
         if self.FORCE_DEBUG_LEVEL is True:
             self.__set_force_debug__(self.LOGGING)
 
+        if self.HANDLER_MODE in ('async', 'aggregate'):
+            self.LOGGING = self.__set_async_handlers__(self.LOGGING)
+
         logging.config.dictConfig(self.LOGGING)
+        update_min_level()
+        install_level_hook()
+
+        # Instrumentation is imported only when it's used, as it
+        # pulls in every handler.
+        if self.INSTRUMENTATION is True:
+            from gcpi.stackdriverlog import instrumentation
+            instrumentation.enable(self.INSTRUMENTATION_REPORT_INTERVAL)
+        elif 'gcpi.stackdriverlog.instrumentation' in sys.modules:
+            sys.modules['gcpi.stackdriverlog.instrumentation'].disable()
 
     def __getattr__(self, attr):
         if attr not in self.defaults:
@@ -142,6 +289,22 @@ class Settings:
             elif key == 'level':
                 config[key] = 'DEBUG'
 
+    def __set_async_handlers__(self, config):
+        handlers = {}
+        for name, handler in config.get('handlers', {}).items():
+            if handler.get('class') in STREAM_HANDLER_CLASSES:
+                handler = dict(handler, **{
+                    'class': 'gcpi.stackdriverlog.handlers.AsyncStreamHandler',
+                    'queue_size': self.ASYNC_HANDLER_QUEUE_SIZE,
+                    'overflow': self.ASYNC_HANDLER_OVERFLOW,
+                    'batch_size': self.ASYNC_HANDLER_BATCH_SIZE,
+                })
+                if self.HANDLER_MODE == 'aggregate':
+                    handler['class'] = 'gcpi.stackdriverlog.aggregator.AggregatorHandler'
+                    handler['socket_path'] = self.AGGREGATOR_SOCKET
+            handlers[name] = handler
+        return dict(config, handlers=handlers)
+
     @property
     def user_settings(self):
         if not hasattr(self, '_user_settings'):
@@ -149,13 +312,81 @@ class Settings:
         return self._user_settings
 
 
-settings = Settings(USER_SETTINGS, DEFAULTS)
+class LazySettings:
+    """
+    Stands in for the ``Settings``, which are only built, and logging only
+    configured, the first time a setting is read. Reloading the settings
+    swaps the ``Settings`` behind it, so references to ``settings`` taken
+    earlier stay current.
+    """
+    def __init__(self):
+        self._wrapped = None
+        self._lock = threading.RLock()
+        self._loading = False
+
+    def __getattr__(self, attr):
+        if self._wrapped is None:
+            self.setup()
+        return getattr(self._wrapped, attr)
+
+    def setup(self):
+        """
+        Load the settings, unless they're loaded already.
+        """
+        with self._lock:
+            # Logging while the settings are being loaded must not load them again.
+            if self._wrapped is None and not self._loading:
+                self.configure(read_user_settings())
+
+    def configure(self, user_settings=None):
+        """
+        Build the settings from ``user_settings`` and configure logging.
+        """
+        with self._lock:
+            self._loading = True
+            try:
+                self._wrapped = Settings(user_settings, DEFAULTS)
+            finally:
+                self._loading = False
+
+    @property
+    def configured(self):
+        return self._wrapped is not None
+
+
+settings = LazySettings()
+
+
+def init(user_settings=None):
+    """
+    Load the settings and configure logging now. Without ``user_settings``,
+    the settings are read from Django, if it's installed.
+    """
+    settings.configure(user_settings if user_settings is not None else read_user_settings())
+    return settings
+
+
+def configure_on_first_use(*args):
+    """
+    structlog logger factory used until the settings are loaded. Loads them
+    the first time a logger is used, and hands over to the logger factory
+    they configure.
+    """
+    settings.setup()
+    logger_factory = structlog.get_config()['logger_factory']
+    if logger_factory is configure_on_first_use:
+        logger_factory = structlog.stdlib.LoggerFactory(ignore_frame_names=[__name__])
+    return logger_factory(*args)
+
+
+# structlog reads the rest of its configuration after it has called
+# the logger factory, so the first logger gets the loaded configuration.
+structlog.configure(logger_factory=configure_on_first_use)
 
 
 def load_settings(*args, **kwargs):
-    global settings
     setting, value = kwargs['setting'], kwargs['value']
     if setting == 'STACK_DRIVER_LOGGER':
-        settings = Settings(value, DEFAULTS)
+        settings.configure(value)
     elif (compat.django_support or compat.flask_support) and setting == 'LOGGING':
-        settings = Settings({'LOGGING': value}, DEFAULTS)
+        settings.configure({'LOGGING': value} if value is not None else None)
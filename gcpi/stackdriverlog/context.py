@@ -0,0 +1,83 @@
+# -*- coding: utf-8 -*-
+"""
+Request scoped logging context. Kept in ``contextvars``, so that it follows
+the request across threads and asyncio tasks without leaking between requests.
+"""
+import collections
+import contextvars
+import re
+
+# Logger bound to the current request by ``AsyncRequestLoggingMiddleware``.
+request_logger = contextvars.ContextVar('request_logger', default=None)
+
+
+def get_request_logger():
+    """
+    Returns the logger bound to the current request, or None
+    outside of a request.
+    """
+    return request_logger.get()
+
+
+class TraceContext(collections.namedtuple('TraceContext', 'trace_id span_id sampled request_id')):
+    """
+    Trace and request id of the current request, parsed once
+    from its headers by the request logging middleware.
+    """
+    __slots__ = ()
+
+
+# Trace context of the current request, added to every event
+# by ``gcpi.stackdriverlog.processors.TraceContextProcessor``.
+trace_context = contextvars.ContextVar('trace_context', default=None)
+
+_TRACEPARENT = re.compile(r'^[0-9a-f]{2}-([0-9a-f]{32})-([0-9a-f]{16})-([0-9a-f]{2})')
+_CLOUD_TRACE_CONTEXT = re.compile(r'^([0-9a-fA-F]{32})(?:/(\d+))?(?:;o=([01]))?')
+
+
+def parse_traceparent(header):
+    """
+    Returns (trace id, span id, sampled) from a W3C ``traceparent`` header, or None.
+    """
+    match = _TRACEPARENT.match(header.strip().lower())
+    if match is None:
+        return None
+    trace_id, span_id, flags = match.groups()
+    if trace_id == '0' * 32 or span_id == '0' * 16:
+        return None
+    return trace_id, span_id, bool(int(flags, 16) & 1)
+
+
+def parse_cloud_trace_context(header):
+    """
+    Returns (trace id, span id, sampled) from an ``X-Cloud-Trace-Context``
+    header, or None. The decimal span id is converted to hex, as Cloud Logging
+    expects it.
+    """
+    match = _CLOUD_TRACE_CONTEXT.match(header.strip())
+    if match is None:
+        return None
+    trace_id, span_id, sampled = match.groups()
+    if span_id is not None:
+        span_id = '%016x' % (int(span_id) & 0xFFFFFFFFFFFFFFFF)
+    return trace_id.lower(), span_id, sampled == '1'
+
+
+def parse_trace_headers(traceparent=None, cloud_trace_context=None):
+    """
+    Returns (trace id, span id, sampled) from the first valid header,
+    or (None, None, None).
+    """
+    parsed = None
+    if traceparent:
+        parsed = parse_traceparent(traceparent)
+    if parsed is None and cloud_trace_context:
+        parsed = parse_cloud_trace_context(cloud_trace_context)
+    return parsed or (None, None, None)
+
+
+def get_trace_context():
+    """
+    Returns the ``TraceContext`` of the current request, or None outside of a request.
+    """
+    return trace_context.get()
@@ -1,12 +1,8 @@
 # -*- coding: utf-8 -*-
-try:
-    import django
-    django_support = True
-except ImportError:
-    django_support = False
+"""
+Frameworks we integrate with, detected without importing them.
+"""
+from importlib.util import find_spec
 
-try:
-    import flask
-    flask_support = True
-except ImportError:
-    flask_support = False
+django_support = find_spec('django') is not None
+flask_support = find_spec('flask') is not None
@@ -1,9 +1,9 @@
 from django.apps import AppConfig
 from django.core.signals import setting_changed
 
-from gcpi.stackdriverlog.conf import load_settings
+from gcpi.stackdriverlog.conf import load_settings, settings
+
 
-print("Loaded StackDriverLoggerConfig file")
 class StackDriverLoggerConfig(AppConfig):
     name = 'gcpi.stackdriverlog'
 
@@ -11,3 +11,7 @@ class StackDriverLoggerConfig(AppConfig):
         # Connect the settings_changed signal so that we can
         # pick up changes from django settings.
         setting_changed.connect(load_settings)
+
+        # Configure logging for Django's own loggers too, rather than
+        # waiting for the first structlog logger to be used.
+        settings.setup()
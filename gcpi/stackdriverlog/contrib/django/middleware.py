@@ -1,61 +1,336 @@
+import contextlib
 import re
+import random
 import structlog
 import json
+import time
 
-from django.utils import timezone
 from gcpi.stackdriverlog.conf import settings
+from gcpi.stackdriverlog.contrib.django.queries import QueryStats
+from gcpi.stackdriverlog.context import TraceContext, parse_trace_headers, request_logger, trace_context
+from gcpi.stackdriverlog.metrics import request_latency
+from gcpi.stackdriverlog.profiling import sampler
+
+try:
+    from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+except ImportError:
+    # asgiref < 3.6
+    from asyncio import coroutines, iscoroutinefunction
+
+    def markcoroutinefunction(func):
+        func._is_coroutine = coroutines._is_coroutine
+        return func
+
+
+def combine_patterns(patterns):
+    """
+    Compile regular expressions into a single alternation,
+    or None if there are none.
+    """
+    patterns = [f'(?:{pattern})' for pattern in patterns]
+    return re.compile('|'.join(patterns)) if patterns else None
+
+
+def is_json(content_type):
+    """
+    True for ``application/json`` and ``application/*+json`` content types.
+    """
+    return content_type == 'application/json' or (
+        content_type.startswith('application/') and content_type.endswith('+json'))
+
+
+def read_body(request):
+    """
+    Returns the JSON request body to log, with sensitive parameters removed
+    at any depth.
+
+    Only JSON bodies no longer than ``REQUEST_MIDDLEWARE_BODY_MAX_LENGTH``
+    bytes are logged, based on the ``Content-Length`` header, or on the
+    length of the body read when there's none (chunked, HTTP/2). The body
+    is read through ``request.body``, which keeps it available for the view.
+    """
+    if not is_json(request.content_type or ''):
+        return dict()
+
+    max_length = settings.REQUEST_MIDDLEWARE_BODY_MAX_LENGTH
+    content_length = request.META.get('CONTENT_LENGTH')
+    if content_length:
+        try:
+            length = int(content_length)
+        except ValueError:
+            return dict()
+        if length > max_length:
+            return f"Body too big: It's over {max_length}."
+
+    try:
+        body = request.body
+    except Exception:
+        return dict()
+    if not body:
+        return dict()
+    if len(body) > max_length:
+        return f"Body too big: It's over {max_length}."
+
+    sensitive = frozenset(settings.REQUEST_MIDDLEWARE_SENSITIVE_POST_PARAMETERS)
+
+    def remove_sensitive(obj):
+        for param in sensitive.intersection(obj):
+            if obj[param] is not None:
+                obj[param] = "%s (removed)" % ('x'*8)
+        return obj
+
+    try:
+        return json.loads(body, object_hook=remove_sensitive)
+    except Exception:
+        return dict()
+
+
+def request_trace_context(request):
+    """
+    Returns the ``TraceContext`` of the request, parsed from its
+    ``traceparent`` or ``X-Cloud-Trace-Context`` header.
+    """
+    meta = request.META
+    trace_id, span_id, sampled = parse_trace_headers(
+        meta.get('HTTP_TRACEPARENT'), meta.get('HTTP_X_CLOUD_TRACE_CONTEXT'))
+    return TraceContext(trace_id, span_id, sampled, meta.get(settings.LOG_REQUEST_ID_HEADER))
+
+
+def route_of(request):
+    """
+    Returns the URL pattern the request was resolved to, so that latencies
+    aren't kept per path. Unresolved requests share a single route.
+    """
+    match = getattr(request, 'resolver_match', None)
+    if match is None:
+        return '<unresolved>'
+    return getattr(match, 'route', None) or match.view_name
 
 
 class RequestLoggingMiddleware(object):
     """
     Adds request.logger to each request to use structlog.
     Makes log on each response
+
+    The trace and request id of the request are kept in
+    ``gcpi.stackdriverlog.context.trace_context`` while it's handled,
+    so that they are added to everything logged meanwhile.
     """
     IGNORE_PATHS = list(map(re.compile, settings.REQUEST_MIDDLEWARE_IGNORE_PATHS))
+    SAMPLING_RATES = settings.REQUEST_MIDDLEWARE_SAMPLING_RATES
     BODY_MAX_LENGTH = settings.REQUEST_MIDDLEWARE_BODY_MAX_LENGTH
     SENSITIVE_POST_PARAMETERS = settings.REQUEST_MIDDLEWARE_SENSITIVE_POST_PARAMETERS
+    LATENCY_HISTOGRAMS = settings.REQUEST_MIDDLEWARE_LATENCY_HISTOGRAMS
+    LATENCY_SNAPSHOT_INTERVAL = settings.REQUEST_MIDDLEWARE_LATENCY_SNAPSHOT_INTERVAL
+    QUERY_STATS = settings.REQUEST_MIDDLEWARE_QUERY_STATS
+    QUERY_STATS_SLOWEST = settings.REQUEST_MIDDLEWARE_QUERY_STATS_SLOWEST
+    PROFILE_THRESHOLD = settings.REQUEST_MIDDLEWARE_PROFILE_THRESHOLD
+    PROFILE_INTERVAL = settings.REQUEST_MIDDLEWARE_PROFILE_INTERVAL
+    PROFILE_MAX_CONCURRENT = settings.REQUEST_MIDDLEWARE_PROFILE_MAX_CONCURRENT
 
     def __init__(self, get_response):
         self.get_response = get_response
 
+        # Match all ignore patterns with a single regular expression.
+        self.ignore_paths = combine_patterns(expr.pattern for expr in self.IGNORE_PATHS)
+
+        # One named group per sampled route, to look up the rate of the one that matched.
+        self.sampling_rates = {f'_{i}': rate for i, rate in enumerate(self.SAMPLING_RATES.values())}
+        self.sampling_paths = combine_patterns(
+            f'(?P<_{i}>{pattern})' for i, pattern in enumerate(self.SAMPLING_RATES))
+
+        if self.LATENCY_HISTOGRAMS and self.LATENCY_SNAPSHOT_INTERVAL:
+            request_latency.set_snapshot_interval(self.LATENCY_SNAPSHOT_INTERVAL)
+
+        if self.PROFILE_THRESHOLD is not None:
+            sampler.configure(self.PROFILE_INTERVAL, self.PROFILE_MAX_CONCURRENT)
+
     def __call__(self, request):
-        self.pre_response(request)
-        response = self.get_response(request)
-        self.post_response(request, response)
-        return response
+        token = trace_context.set(request_trace_context(request))
+        try:
+            request.start = time.perf_counter_ns()
+            if not self.should_log(request):
+                request.logger = structlog.getLogger(__name__)
+                response = self.get_response(request)
+                self.record_latency(request, response)
+                return response
+
+            self.pre_response(request)
+            with self.record_queries(request), self.profile(request):
+                response = self.get_response(request)
+            self.record_latency(request, response)
+            self.post_response(request, response)
+            return response
+        finally:
+            trace_context.reset(token)
 
     def process_exception(self, request, exception):
         request.logger.exception(exception)
 
+    def should_log(self, request):
+        """
+        Decide if the request should be logged, before doing any work to log it.
+        """
+        if request.method == 'OPTIONS':
+            return False
+
+        path = request.path
+        if self.ignore_paths is not None and self.ignore_paths.match(path):
+            return False
+
+        if self.sampling_paths is not None:
+            match = self.sampling_paths.match(path)
+            if match is not None:
+                return random.random() < self.sampling_rates[match.lastgroup]
+        return True
+
     @staticmethod
     def pre_response(request):
-        request.start = timezone.now()
+        request.logger = RequestLoggingMiddleware.bind_logger(request)
+
+    @staticmethod
+    def bind_logger(request):
+        """
+        Returns a logger bound to the request details. The request id
+        is added from the trace context instead.
+        """
         message = f"{request.method} {request.path}"
 
-        try:
-            bodys = request.body.decode('utf-8')
-
-            if len(bodys) > settings.REQUEST_MIDDLEWARE_BODY_MAX_LENGTH:
-                body = f"Body too big: It's over {settings.REQUEST_MIDDLEWARE_BODY_MAX_LENGTH}."
-            else:
-                body = json.loads(bodys)
-                for param in settings.REQUEST_MIDDLEWARE_SENSITIVE_POST_PARAMETERS:
-                    if body.get(param, None) is not None:
-                        body[param] = "%s (removed)" % ('x'*8)
-        except:
-            body = dict()
-
-        request.logger = structlog.getLogger(__name__).bind(message=message,
+        body = read_body(request)
+
+        return structlog.getLogger(__name__).bind(message=message,
             path=request.path, method=request.method, query_params=dict(request.GET), body=body)
 
-        if hasattr(request.META, settings.LOG_REQUEST_ID_HEADER):
-            request.logger = request.logger.bind(request_id=request.META[settings.LOG_REQUEST_ID_HEADER])
+    def record_queries(self, request):
+        """
+        Returns a context manager recording the database queries made while
+        handling the request in ``request.query_stats``, if enabled.
+        """
+        if not self.QUERY_STATS:
+            return contextlib.nullcontext()
+        request.query_stats = QueryStats(self.QUERY_STATS_SLOWEST)
+        return request.query_stats
+
+    def profile(self, request):
+        """
+        Returns a context manager sampling the stack of the request thread
+        in ``request.profile``, if profiling is enabled.
+        """
+        if self.PROFILE_THRESHOLD is None:
+            return contextlib.nullcontext()
+        request.profile = sampler.profile()
+        return request.profile
+
+    def profile_fields(self, request):
+        """
+        Returns the profile of the request to log, if it took longer than
+        ``PROFILE_THRESHOLD`` seconds and was sampled.
+        """
+        profile = getattr(request, 'profile', None)
+        if profile is None or not profile.samples or request.duration_ns < self.PROFILE_THRESHOLD * 1e9:
+            return {}
+        return {'profile': profile.folded(), 'profile_samples': profile.samples}
+
+    def record_latency(self, request, response):
+        """
+        Set ``request.duration_ns`` from the monotonic ``request.start``,
+        and add it to the latency histogram of the request route.
+        """
+        request.duration_ns = time.perf_counter_ns() - request.start
+        if self.LATENCY_HISTOGRAMS:
+            request_latency.record(route_of(request), request.method, response.status_code, request.duration_ns)
 
     def post_response(self, request, response):
-        request.logger = request.logger.bind(status=response.status_code,
-                                             duration_ms=(timezone.now() - request.start).microseconds / 1000)
+        request.logger = self.log_response(request.logger, request, response)
+        return response
+
+    def log_response(self, logger, request, response):
+        logger = logger.bind(status=response.status_code,
+                             duration_ms=round(request.duration_ns / 1e6, 3))
+        query_stats = getattr(request, 'query_stats', None)
+        if query_stats is not None:
+            logger = logger.bind(db=query_stats.summary())
+        # The profile is only logged once, not bound.
+        logger.info(event='request', **self.profile_fields(request))
+        return logger
+
+
+class AsyncRequestLoggingMiddleware(RequestLoggingMiddleware):
+    """
+    Async capable variant of ``RequestLoggingMiddleware``, that runs
+    without a thread hop under ASGI.
 
-        # Check if request path matches any ignore patterns. If not, log the request.
-        if not any([expr.match(request.path) for expr in self.IGNORE_PATHS]) and not request.method in ['OPTIONS']:
-            request.logger.info(event='request')
+    Database queries are only recorded, and requests only profiled, when it
+    runs synchronously, as under ASGI requests share the event loop thread
+    and queries are made from other threads.
+
+    The bound logger is kept in ``gcpi.stackdriverlog.context.request_logger``
+    instead of on ``request.logger``, and can be fetched with
+    ``gcpi.stackdriverlog.context.get_request_logger()``.
+    """
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        super(AsyncRequestLoggingMiddleware, self).__init__(get_response)
+        if iscoroutinefunction(self.get_response):
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+
+        context_token = trace_context.set(request_trace_context(request))
+        try:
+            request.start = time.perf_counter_ns()
+            if not self.should_log(request):
+                response = self.get_response(request)
+                self.record_latency(request, response)
+                return response
+
+            token = self.pre_response(request)
+            try:
+                with self.record_queries(request), self.profile(request):
+                    response = self.get_response(request)
+                self.record_latency(request, response)
+                self.post_response(request, response)
+            finally:
+                request_logger.reset(token)
+            return response
+        finally:
+            trace_context.reset(context_token)
+
+    async def __acall__(self, request):
+        context_token = trace_context.set(request_trace_context(request))
+        try:
+            request.start = time.perf_counter_ns()
+            if not self.should_log(request):
+                response = await self.get_response(request)
+                self.record_latency(request, response)
+                return response
+
+            token = self.pre_response(request)
+            try:
+                response = await self.get_response(request)
+                self.record_latency(request, response)
+                self.post_response(request, response)
+            finally:
+                request_logger.reset(token)
+            return response
+        finally:
+            trace_context.reset(context_token)
+
+    def process_exception(self, request, exception):
+        # Requests that aren't logged have no bound logger, their
+        # exceptions are logged all the same.
+        logger = request_logger.get()
+        if logger is None:
+            logger = structlog.getLogger(__name__)
+        logger.exception(exception)
+
+    def pre_response(self, request):
+        return request_logger.set(self.bind_logger(request))
+
+    def post_response(self, request, response):
+        self.log_response(request_logger.get(), request, response)
         return response
@@ -0,0 +1,124 @@
+# -*- coding: utf-8 -*-
+"""
+Per-request database query statistics, recorded by the request logging
+middleware with ``connection.execute_wrapper``.
+"""
+import contextlib
+import heapq
+import re
+import time
+
+from django.db import connections
+
+# Literals and placeholders replaced to make the fingerprint of a statement.
+_STRINGS = re.compile(r"'(?:[^']|'')*'")
+_NUMBERS = re.compile(r'\b\d+(?:\.\d+)?\b')
+_PLACEHOLDERS = re.compile(r'%s|%\(\w+\)s|\?')
+_LISTS = re.compile(r'\((?:\s*\?\s*,)+\s*\?\s*\)')
+_WHITESPACE = re.compile(r'\s+')
+
+
+def fingerprint(sql):
+    """
+    Returns ``sql`` with its literals and placeholders replaced by '?', and
+    lists of them by '(...)', so that statements differing only by their
+    parameters look the same.
+    """
+    sql = _STRINGS.sub('?', sql)
+    sql = _NUMBERS.sub('?', sql)
+    sql = _PLACEHOLDERS.sub('?', sql)
+    sql = _LISTS.sub('(...)', sql)
+    return _WHITESPACE.sub(' ', sql).strip()
+
+
+class AliasStats:
+    """
+    Queries made on one database alias during a request.
+    """
+    __slots__ = ('count', 'time_ns', 'statements', 'slowest', 'slowest_by_key')
+
+    def __init__(self):
+        self.count = 0
+        self.time_ns = 0
+        # Number of executions by hash of the statement.
+        self.statements = {}
+        # Min heap of [max duration, hash, statement] of the slowest
+        # statements, one entry per statement, also kept by hash.
+        self.slowest = []
+        self.slowest_by_key = {}
+
+
+class QueryStats:
+    """
+    Counts the queries, and the time spent in them, of each database alias,
+    and keeps the SQL of the ``slowest`` distinct statements only, with the
+    longest time each of them took. Statements are compared by hash to count
+    duplicates, as the same ORM query run in a loop (N+1) sends the same SQL
+    with different parameters.
+
+    Use as a context manager around the handling of a request. Queries are
+    only recorded in the thread that entered it, as connections are per thread.
+    """
+    def __init__(self, slowest=5):
+        self.max_slowest = slowest
+        self.aliases = {}
+        self._stack = None
+
+    def __enter__(self):
+        self._stack = contextlib.ExitStack()
+        for alias in connections:
+            self._stack.enter_context(connections[alias].execute_wrapper(self))
+        return self
+
+    def __exit__(self, *exc_info):
+        stack, self._stack = self._stack, None
+        return stack.__exit__(*exc_info)
+
+    def __call__(self, execute, sql, params, many, context):
+        start = time.perf_counter_ns()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            self.record(context['connection'].alias, sql, time.perf_counter_ns() - start)
+
+    def record(self, alias, sql, duration_ns):
+        stats = self.aliases.get(alias)
+        if stats is None:
+            stats = self.aliases[alias] = AliasStats()
+        stats.count += 1
+        stats.time_ns += duration_ns
+        key = hash(sql)
+        stats.statements[key] = stats.statements.get(key, 0) + 1
+
+        slowest, by_key = stats.slowest, stats.slowest_by_key
+        entry = by_key.get(key)
+        if entry is not None:
+            if duration_ns > entry[0]:
+                entry[0] = duration_ns
+                heapq.heapify(slowest)
+        elif len(slowest) < self.max_slowest:
+            entry = by_key[key] = [duration_ns, key, sql]
+            heapq.heappush(slowest, entry)
+        elif slowest and duration_ns > slowest[0][0]:
+            entry = by_key[key] = [duration_ns, key, sql]
+            del by_key[heapq.heapreplace(slowest, entry)[1]]
+
+    def summary(self):
+        """
+        Returns the statistics of each alias that was queried, to log.
+        """
+        summary = {}
+        for alias, stats in self.aliases.items():
+            statements = stats.statements
+            summary[alias] = {
+                'queries': stats.count,
+                'time_ms': round(stats.time_ns / 1e6, 3),
+                # Queries that repeated a statement run before in the request.
+                'duplicates': stats.count - len(statements),
+                'max_repeats': max(statements.values()),
+                'slowest': [
+                    {'sql': fingerprint(sql), 'ms': round(duration_ns / 1e6, 3), 'repeats': statements[key]}
+                    for duration_ns, key, sql in sorted(stats.slowest, reverse=True)
+                ],
+            }
+        return summary
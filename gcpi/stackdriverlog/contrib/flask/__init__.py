@@ -1,6 +1,13 @@
 # -*- coding: utf-8 -*-
+import threading
+
 try:
-    from flask.signals import appcontext_pushed, signals_available
+    from flask.signals import appcontext_pushed
+    try:
+        from flask.signals import signals_available
+    except ImportError:
+        # Flask 2.3+ always has signals, as blinker is a requirement.
+        signals_available = True
 except ImportError:
     # Flask not supported because it is not imported
     signals_available = False
@@ -9,14 +16,46 @@ except ImportError:
 from gcpi.stackdriverlog.conf import load_settings
 
 
+def fingerprint(value):
+    """
+    Cheap fingerprint of a ``LOGGING`` config, used to tell if it changed.
+    """
+    return hash(repr(value))
+
+
+# Fingerprint of the ``LOGGING`` config currently loaded, by any app.
+# ``None`` means the defaults, which are loaded on the first use of a logger.
+_loaded_fingerprint = fingerprint(None)
+_lock = threading.Lock()
+
+
 def signal_handler(sender, **kwargs):
     """
     Signals receiver for ``flask.appcontext_pushed`` signal.
     Get ``STACK_DRIVER_LOGGER`` namespace from flask app config, and
     reload the settings used to instantiate the ``StackDriverLogger`` class.
+
+    The app context is pushed for every request, so settings are only
+    reloaded when the ``LOGGING`` config of the app is replaced by a
+    different one. The config last seen is kept in ``app.extensions['gcpi']``,
+    changes made in place to it are not picked up.
     """
+    global _loaded_fingerprint
     user_settings = sender.config.get('LOGGING', None)
-    load_settings(setting='LOGGING', value=user_settings)
+    seen = sender.extensions.get('gcpi')
+    if seen is not None and seen['logging'] is user_settings:
+        user_fingerprint = seen['fingerprint']
+    else:
+        user_fingerprint = fingerprint(user_settings)
+        sender.extensions['gcpi'] = {'logging': user_settings, 'fingerprint': user_fingerprint}
+    # Settings are global, so apps with different configs reload them in turn.
+    if user_fingerprint == _loaded_fingerprint:
+        return
+
+    with _lock:
+        if user_fingerprint != _loaded_fingerprint:
+            load_settings(setting='LOGGING', value=user_settings)
+            _loaded_fingerprint = user_fingerprint
 
 
 if signals_available:
@@ -0,0 +1,383 @@
+# -*- coding: utf-8 -*-
+"""
+Converts plain text and JSON log files written without this package to
+the JSON log entries ``JsonProcessorFormatter`` writes, so that they can
+be ingested again. E.g.
+
+    gcpi-convert-logs app.log.1.gz app.log -o app.json.gz
+    zcat old.log.gz | gcpi-convert-logs > app.json
+
+Each line is one entry. JSON lines have their level, message, time and
+logger name read from the usual keys, and keep their other keys as
+fields. Plain text lines have them read from a leading time, level and
+logger name, if they have any. Times without a timezone are taken as UTC.
+
+Input is split in chunks of whole lines and converted by a pool of
+processes. Uncompressed files are memory-mapped and only the offsets
+of their chunks are sent to the workers. At most ``--window`` chunks are
+in flight, so memory stays the same whatever the size of the input, and
+chunks are written in the order they were read. Compressed output is
+written as one gzip member per chunk, compressed by the workers.
+"""
+import argparse
+import collections
+import datetime
+import gzip
+import json
+import mmap
+import os
+import re
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import structlog
+
+from gcpi.stackdriverlog.formatters import JsonProcessorFormatter
+from gcpi.stackdriverlog.timestamps import split_timestamp
+
+GZIP_MAGIC = b'\x1f\x8b'
+
+# Keys JSON lines are read from, in order of preference.
+LEVEL_KEYS = ('severity', 'level', 'levelname', 'levelno', 'log_level', 'loglevel')
+MESSAGE_KEYS = ('message', 'msg', 'event')
+TIME_KEYS = ('timestamp', 'time', '@timestamp', 'asctime', 'ts', 'date')
+LOGGER_KEYS = ('logger', 'name', 'logger_name')
+
+# Levels of other logging libraries, by the Cloud Logging severity they map to.
+LEVEL_NAMES = {
+    'TRACE': 'DEBUG',
+    'DEBUG': 'DEBUG',
+    'INFO': 'INFO',
+    'NOTICE': 'NOTICE',
+    'WARN': 'WARNING',
+    'WARNING': 'WARNING',
+    'ERR': 'ERROR',
+    'ERROR': 'ERROR',
+    'CRITICAL': 'CRITICAL',
+    'FATAL': 'CRITICAL',
+    'ALERT': 'ALERT',
+    'EMERGENCY': 'EMERGENCY',
+}
+
+# Upper bounds of numeric levels, by the severity they map to, for the
+# levels of the stdlib (10 to 50) and of pino and bunyan (10 to 60).
+STDLIB_LEVEL_NUMBERS = ((10, 'DEBUG'), (20, 'INFO'), (30, 'WARNING'), (40, 'ERROR'))
+PINO_LEVEL_NUMBERS = ((20, 'DEBUG'), (30, 'INFO'), (40, 'WARNING'), (50, 'ERROR'))
+
+# Optional leading time, then level, e.g. '2020-01-02 03:04:05,678 ERROR app.views: Failed',
+# '[2020-01-02T03:04:05Z] [WARN] Retrying' or 'WARNING:app.views:Failed' (logging.basicConfig).
+PLAIN_LINE = re.compile(
+    r'(?:\[?(?P<time>\d{4}-\d\d-\d\d[T ]\d\d:\d\d:\d\d(?:[.,]\d+)?(?:Z|[+-]\d\d:?\d\d)?)\]?\s+)?'
+    r'(?:\[?(?P<level>%s)\]?(?::(?P<logger>[\w.-]+):\s*|:?\s+(?:(?P<name>[\w.-]+):\s+)?))?'
+    r'(?P<message>.*)' % '|'.join(sorted(LEVEL_NAMES, key=len, reverse=True)),
+    re.DOTALL)
+
+# Fractional seconds of an ISO 8601 time, kept to the nanosecond.
+FRACTION = re.compile(r'\d\d:\d\d[.,](\d+)')
+
+
+class Line:
+    """
+    Stands in for a ``logging.LogRecord`` in ``JsonProcessorFormatter.add_fields``.
+    """
+    def __init__(self, levelname, name, message):
+        self.levelname = levelname
+        self.name = name
+        self.message = message
+
+
+def rfc3339(seconds, nanos):
+    return '%s.%09dZ' % (time.strftime('%Y-%m-%dT%H:%M:%S', time.gmtime(seconds)), nanos)
+
+
+def parse_time(value):
+    """
+    Returns an ISO 8601 time, or seconds or milliseconds since the epoch,
+    as an RFC 3339 timestamp, or None if it can't be read. Fractions of
+    seconds are kept to the nanosecond, without going through a float.
+    """
+    if isinstance(value, int) and not isinstance(value, bool):
+        # Milliseconds since the epoch, as written by pino and bunyan.
+        if value > 1e11:
+            return rfc3339(value // 1000, value % 1000 * 1000000)
+        return rfc3339(value, 0)
+    if isinstance(value, float):
+        if value > 1e11:
+            value /= 1000.0
+        return rfc3339(*split_timestamp(value))
+    if not isinstance(value, str):
+        return None
+    try:
+        parsed = datetime.datetime.fromisoformat(value)
+    except ValueError:
+        # Before Python 3.11, only the format isoformat() writes is read.
+        normalized = re.sub(r'(\.\d{6})\d+', r'\1', value.replace(',', '.').replace('Z', '+00:00'))
+        try:
+            parsed = datetime.datetime.fromisoformat(normalized)
+        except ValueError:
+            return None
+    if parsed.tzinfo is None:
+        parsed = parsed.replace(tzinfo=datetime.timezone.utc)
+    fraction = FRACTION.search(value)
+    nanos = int(fraction.group(1)[:9].ljust(9, '0')) if fraction else 0
+    return rfc3339(int(parsed.replace(microsecond=0).timestamp()), nanos)
+
+
+def parse_level(level, fields):
+    """
+    Returns the severity of a level name or number. Numbers are read as
+    pino and bunyan levels in lines with a 'msg', as stdlib levels otherwise.
+    """
+    if isinstance(level, str) and level.isdigit():
+        level = int(level)
+    if isinstance(level, (int, float)) and not isinstance(level, bool):
+        bounds = PINO_LEVEL_NUMBERS if 'msg' in fields else STDLIB_LEVEL_NUMBERS
+        for bound, severity in bounds:
+            if level <= bound:
+                return severity
+        return 'CRITICAL'
+    level = str(level).upper()
+    return LEVEL_NAMES.get(level, level)
+
+
+def pop_first(fields, keys):
+    for key in keys:
+        if key in fields:
+            return fields.pop(key)
+    return None
+
+
+def parse_line(line):
+    """
+    Returns the severity, logger name, message, RFC 3339 time and other
+    fields of a line of text. Messages of JSON lines can be any JSON value.
+    """
+    if line.startswith('{'):
+        try:
+            fields = json.loads(line)
+        except ValueError:
+            fields = None
+        if isinstance(fields, dict):
+            level = pop_first(fields, LEVEL_KEYS)
+            level = parse_level(level, fields) if level is not None else None
+            message = pop_first(fields, MESSAGE_KEYS)
+            # Times that can't be read are kept as they are.
+            timestamp = None
+            for key in TIME_KEYS:
+                if key in fields:
+                    timestamp = parse_time(fields[key])
+                    if timestamp is not None:
+                        del fields[key]
+                    break
+            name = pop_first(fields, LOGGER_KEYS)
+            return level, name, message if message is not None else '', timestamp, fields
+
+    match = PLAIN_LINE.match(line)
+    level = match.group('level')
+    return (
+        LEVEL_NAMES[level] if level else None,
+        match.group('logger') or match.group('name'),
+        match.group('message'),
+        parse_time(match.group('time')) if match.group('time') else None,
+        {},
+    )
+
+
+class Converter:
+    """
+    Converts lines with the field mapping of ``JsonProcessorFormatter``.
+    """
+    def __init__(self, **formatter_kwargs):
+        # Times are written from the line, not from a record.
+        formatter_kwargs.setdefault('timestamp_format', None)
+        self.formatter = JsonProcessorFormatter(structlog.processors.JSONRenderer(), **formatter_kwargs)
+        self.dumpb = self.formatter.backend.dumpb
+
+    def convert_line(self, line):
+        """
+        Returns the entry for a line of text, without line end, or None for blank lines.
+        """
+        if not line or line.isspace():
+            return None
+        level, name, message, timestamp, fields = parse_line(line)
+        fields.setdefault('event', message)
+        # Structured messages are kept as they are, like the events of
+        # ``JsonProcessorFormatter``, and also become the 'message'.
+        entry = self.formatter.add_fields(Line(level, name, message if isinstance(message, str) else None), fields)
+        if timestamp is not None:
+            # Without it, Cloud Logging uses the time it receives the entry.
+            entry['timestamp'] = timestamp
+        return self.dumpb(entry)
+
+    def convert(self, data):
+        """
+        Converts a chunk of whole lines to entries, one per line.
+        """
+        convert_line = self.convert_line
+        entries = []
+        # Not splitlines(), which also splits on form feeds and other separators.
+        for line in data.decode('utf-8', 'replace').split('\n'):
+            if line.endswith('\r'):
+                line = line[:-1]
+            entry = convert_line(line)
+            if entry is not None:
+                entries.append(entry)
+        if not entries:
+            return b''
+        entries.append(b'')
+        return b'\n'.join(entries)
+
+
+# State of a worker process, set by ``init_worker``.
+_converter = None
+_compresslevel = None
+_mapped = (None, None, None)
+
+
+def init_worker(compresslevel):
+    global _converter, _compresslevel
+    _converter = Converter()
+    _compresslevel = compresslevel
+
+
+def convert_chunk(chunk):
+    """
+    Converts a chunk, given as bytes or as the (path, start, end) of a
+    memory-mapped file, and compresses it if output is compressed.
+    """
+    global _mapped
+    if isinstance(chunk, tuple):
+        path, start, end = chunk
+        if _mapped[0] != path:
+            if _mapped[1] is not None:
+                _mapped[1].close()
+                _mapped[2].close()
+            f = open(path, 'rb')
+            _mapped = (path, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ), f)
+        mapped = _mapped[1]
+        chunk = mapped[start:end]
+        if hasattr(mapped, 'madvise'):
+            # Drop the pages read from the mapping, or they would count
+            # towards the memory of the worker until the file is done.
+            offset = start - start % mmap.PAGESIZE
+            mapped.madvise(mmap.MADV_DONTNEED, offset, end - offset)
+
+    data = _converter.convert(chunk)
+    if _compresslevel is not None and data:
+        data = gzip.compress(data, compresslevel=_compresslevel)
+    return data
+
+
+def is_gzip(path):
+    with open(path, 'rb') as f:
+        return f.read(2) == GZIP_MAGIC
+
+
+def file_chunks(path, chunk_size):
+    """
+    Yields the (path, start, end) of chunks of whole lines of an
+    uncompressed file, found in the memory-mapped file.
+    """
+    size = os.path.getsize(path)
+    if not size:
+        return
+    with open(path, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+        start = 0
+        while start < size:
+            end = mapped.find(b'\n', min(start + chunk_size, size) - 1)
+            end = size if end == -1 else end + 1
+            yield path, start, end
+            start = end
+
+
+def stream_chunks(stream, chunk_size):
+    """
+    Yields chunks of whole lines read from a binary stream.
+    """
+    while True:
+        data = stream.read(chunk_size)
+        if not data:
+            return
+        if not data.endswith(b'\n'):
+            data += stream.readline()
+        yield data
+
+
+def input_chunks(paths, chunk_size):
+    """
+    Yields the chunks of each input, in order. '-' is stdin.
+    """
+    for path in paths:
+        if path == '-':
+            stream = sys.stdin.buffer
+            if stream.peek(2)[:2] == GZIP_MAGIC:
+                stream = gzip.GzipFile(fileobj=stream)
+            yield from stream_chunks(stream, chunk_size)
+        elif is_gzip(path):
+            with gzip.open(path, 'rb') as stream:
+                yield from stream_chunks(stream, chunk_size)
+        else:
+            yield from file_chunks(path, chunk_size)
+
+
+def convert(paths, output, chunk_size=4 * 1024 * 1024, workers=None, window=None, compresslevel=None):
+    """
+    Converts the ``paths`` to the binary stream ``output``, with
+    ``workers`` processes, or in this process if 0. With ``compresslevel``,
+    output is gzip compressed. Returns the number of chunks converted.
+    """
+    chunks = input_chunks(paths, chunk_size)
+    if workers == 0:
+        init_worker(compresslevel)
+        count = 0
+        for chunk in chunks:
+            output.write(convert_chunk(chunk))
+            count += 1
+        return count
+
+    workers = workers or os.cpu_count() or 1
+    window = window or workers * 2
+    pending = collections.deque()
+    count = 0
+    with ProcessPoolExecutor(workers, initializer=init_worker, initargs=(compresslevel,)) as pool:
+        for chunk in chunks:
+            if len(pending) >= window:
+                output.write(pending.popleft().result())
+            pending.append(pool.submit(convert_chunk, chunk))
+            count += 1
+        while pending:
+            output.write(pending.popleft().result())
+    return count
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Convert plain text and JSON logs to Cloud Logging JSON entries, one per line.')
+    parser.add_argument('paths', nargs='*', default=['-'],
+                        help='files to convert, gzip compressed or not, or - for stdin (default)')
+    parser.add_argument('-o', '--output', default='-', help='file to write to, or - for stdout (default)')
+    parser.add_argument('-z', '--gzip', action='store_true',
+                        help='compress the output, the default for output files ending with .gz')
+    parser.add_argument('--compresslevel', type=int, default=6, help='gzip compression level (default 6)')
+    parser.add_argument('-j', '--workers', type=int, default=None,
+                        help='worker processes (default: number of CPUs), 0 to convert in this process')
+    parser.add_argument('--chunk-size', type=int, default=4 * 1024 * 1024, help='bytes per chunk (default 4 MB)')
+    parser.add_argument('--window', type=int, default=None,
+                        help='max chunks in flight (default: twice the number of workers)')
+    args = parser.parse_args(argv)
+
+    compress = args.gzip or args.output.endswith('.gz')
+    output = sys.stdout.buffer if args.output == '-' else open(args.output, 'wb')
+    try:
+        convert(args.paths, output, args.chunk_size, args.workers, args.window,
+                args.compresslevel if compress else None)
+    finally:
+        if output is not sys.stdout.buffer:
+            output.close()
+        else:
+            output.flush()
+
+
+if __name__ == '__main__':
+    main()
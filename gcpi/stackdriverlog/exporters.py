@@ -0,0 +1,290 @@
+# -*- coding: utf-8 -*-
+"""
+Handler that writes log entries straight to the Cloud Logging API,
+instead of printing them for the logging agent to pick up.
+"""
+import gzip
+import http.client
+import json
+import logging
+import os
+import queue
+import random
+import sys
+import time
+import urllib.parse
+
+from gcpi.stackdriverlog.formatters import JsonProcessorFormatter
+from gcpi.stackdriverlog.handlers import QueuedHandler
+from gcpi.stackdriverlog.timestamps import format_timestamp
+
+DEFAULT_ENDPOINT = 'https://logging.googleapis.com'
+WRITE_PATH = '/v2/entries:write'
+
+METADATA_HOST = 'metadata.google.internal'
+METADATA_TOKEN_PATH = '/computeMetadata/v1/instance/service-accounts/default/token'
+METADATA_PROJECT_PATH = '/computeMetadata/v1/project/project-id'
+
+# Responses after which a batch is sent again.
+RETRY_STATUSES = frozenset((401, 408, 429, 500, 502, 503, 504))
+
+# Values of the LogSeverity enum, by level name.
+SEVERITIES = {
+    'DEFAULT': 'DEFAULT',
+    'DEBUG': 'DEBUG',
+    'INFO': 'INFO',
+    'NOTICE': 'NOTICE',
+    'WARNING': 'WARNING',
+    'WARN': 'WARNING',
+    'ERROR': 'ERROR',
+    'CRITICAL': 'CRITICAL',
+    'FATAL': 'CRITICAL',
+    'ALERT': 'ALERT',
+    'EMERGENCY': 'EMERGENCY',
+}
+
+# Upper bounds of stdlib level numbers, by the severity they map to.
+SEVERITY_LEVELS = ((logging.DEBUG, 'DEBUG'), (logging.INFO, 'INFO'), (logging.WARNING, 'WARNING'),
+                   (logging.ERROR, 'ERROR'))
+
+
+def severity_of(record):
+    """
+    Returns the LogSeverity of a record. Custom levels are mapped by
+    number, and records without a level get DEFAULT.
+    """
+    severity = SEVERITIES.get(str(record.levelname).upper())
+    if severity is not None:
+        return severity
+    levelno = record.levelno
+    if not isinstance(levelno, int) or levelno <= logging.NOTSET:
+        return 'DEFAULT'
+    for bound, severity in SEVERITY_LEVELS:
+        if levelno <= bound:
+            return severity
+    return 'CRITICAL'
+
+
+def metadata_get(path, timeout=5.0):
+    """
+    Returns the body of a GET request to the metadata server.
+    """
+    connection = http.client.HTTPConnection(METADATA_HOST, timeout=timeout)
+    try:
+        connection.request('GET', path, headers={'Metadata-Flavor': 'Google'})
+        response = connection.getresponse()
+        body = response.read()
+        if response.status != 200:
+            raise OSError('Metadata server returned %s for %s' % (response.status, path))
+        return body
+    finally:
+        connection.close()
+
+
+class MetadataToken:
+    """
+    Access token of the default service account, fetched from the metadata
+    server and cached until shortly before it expires.
+    """
+    def __init__(self, timeout=5.0):
+        self.timeout = timeout
+        self._token = None
+        self._expires = 0.0
+
+    def __call__(self):
+        if self._token is None or time.monotonic() >= self._expires:
+            data = json.loads(metadata_get(METADATA_TOKEN_PATH, self.timeout))
+            self._token = data['access_token']
+            self._expires = time.monotonic() + max(0, data.get('expires_in', 0) - 60)
+        return self._token
+
+    def invalidate(self):
+        self._token = None
+
+
+class CloudLoggingHandler(QueuedHandler):
+    """
+    Sends records to ``entries.write`` of the Cloud Logging API in batches.
+
+    Records are put on a bounded queue, and a single background thread
+    formats them and sends a batch when it holds ``batch_count`` entries,
+    ``batch_bytes`` bytes of formatted records, or when its first record
+    has waited for ``max_latency`` seconds. Records formatted by a
+    ``JsonProcessorFormatter`` are sent as ``jsonPayload`` without being
+    parsed again, anything else as ``textPayload``. Level names that aren't
+    a LogSeverity are mapped by level number.
+
+    Batches are sent gzip compressed over a single kept-alive connection,
+    and retried with exponential backoff on connection errors, 401, 408,
+    429 and 5xx responses. Batches that can't be sent are counted in
+    ``failed``, and records that didn't fit in the queue in ``dropped``.
+
+    :param project: project to log to. Defaults to the GOOGLE_CLOUD_PROJECT
+      environment variable, then to the project of the metadata server.
+    :param log_id: name of the log.
+    :param resource: monitored resource of the entries.
+    :param endpoint: URL of the Cloud Logging API, e.g. a local stand-in.
+    :param token: access token, or a callable returning one. Defaults to
+      the token of the default service account from the metadata server.
+    """
+    thread_name = 'gcpi-cloud-logging'
+
+    def __init__(self, project=None, log_id='python', resource=None, endpoint=DEFAULT_ENDPOINT, token=None,
+                 batch_count=1000, batch_bytes=4 * 1024 * 1024, max_latency=1.0, queue_size=10000,
+                 overflow='drop', max_retries=5, backoff=0.5, max_backoff=30.0, compress=True, timeout=10.0):
+        self.project = project or os.environ.get('GOOGLE_CLOUD_PROJECT')
+        self.log_id = log_id
+        self.resource = resource or {'type': 'global'}
+        self.endpoint = urllib.parse.urlsplit(endpoint)
+        self.token = MetadataToken() if token is None else token
+        self.batch_count = batch_count
+        self.batch_bytes = batch_bytes
+        self.max_latency = max_latency
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.compress = compress
+        self.timeout = timeout
+        self.close_timeout = max_latency + timeout
+
+        # Entries sent, and entries in batches that couldn't be sent.
+        self.sent = 0
+        self.failed = 0
+
+        self._connection = None
+        super(CloudLoggingHandler, self).__init__(queue_size=queue_size, overflow=overflow)
+
+    def _run(self):
+        q = self.queue
+        while True:
+            record = q.get()
+            taken, entries, size = 1, [], 0
+            stop = record is self.STOP
+            deadline = time.monotonic() + self.max_latency
+            while not stop:
+                entry = self.format_entry(record)
+                if entry is not None:
+                    entries.append(entry)
+                    size += len(entry)
+                if len(entries) >= self.batch_count or size >= self.batch_bytes:
+                    break
+                timeout = deadline - time.monotonic()
+                try:
+                    record = q.get(timeout=timeout) if timeout > 0 else q.get_nowait()
+                except queue.Empty:
+                    break
+                taken += 1
+                stop = record is self.STOP
+
+            if entries:
+                self.send(entries)
+            for _ in range(taken):
+                q.task_done()
+            if stop:
+                return
+
+    def format_entry(self, record):
+        """
+        Returns ``record`` as a serialized ``LogEntry``, or None if it can't be formatted.
+        """
+        try:
+            formatter = self.formatter
+            if isinstance(formatter, JsonProcessorFormatter) and not formatter.prefix:
+                payload = b'"jsonPayload":' + formatter.format_bytes(record)
+            else:
+                payload = b'"textPayload":' + json.dumps(self.format(record)).encode('utf-8')
+            return b'{"severity":"%s","timestamp":"%s",%s}' % (
+                severity_of(record).encode('ascii'), format_timestamp(record.created).encode('ascii'), payload)
+        except RecursionError:
+            raise
+        except Exception:
+            self.handleError(record)
+            return None
+
+    def request_body(self, entries):
+        """
+        Returns the ``entries.write`` request body for the serialized ``entries``.
+        """
+        header = json.dumps({
+            'logName': 'projects/%s/logs/%s' % (self.project, urllib.parse.quote(self.log_id, safe='')),
+            'resource': self.resource,
+            'partialSuccess': True,
+        })
+        return header[:-1].encode('utf-8') + b',"entries":[' + b','.join(entries) + b']}'
+
+    def send(self, entries):
+        """
+        Send a batch of serialized entries, retrying with backoff. Returns True if it was written.
+        """
+        try:
+            if self.project is None:
+                self.project = metadata_get(METADATA_PROJECT_PATH).decode('utf-8')
+            body = self.request_body(entries)
+        except Exception as exc:
+            return self._failed(entries, exc)
+
+        headers = {'Content-Type': 'application/json'}
+        if self.compress:
+            body = gzip.compress(body, compresslevel=5)
+            headers['Content-Encoding'] = 'gzip'
+
+        error = None
+        for attempt in range(self.max_retries + 1):
+            if attempt:
+                delay = min(self.max_backoff, self.backoff * 2 ** (attempt - 1))
+                time.sleep(delay * random.uniform(0.5, 1.0))
+            try:
+                token = self.token() if callable(self.token) else self.token
+                if token:
+                    headers['Authorization'] = 'Bearer %s' % token
+                status, response = self.post(body, headers)
+            except Exception as exc:
+                self.close_connection()
+                error = exc
+                continue
+
+            if 200 <= status < 300:
+                self.sent += len(entries)
+                return True
+            error = 'HTTP %s: %s' % (status, response[:500].decode('utf-8', 'replace'))
+            if status == 401 and hasattr(self.token, 'invalidate'):
+                self.token.invalidate()
+            if status not in RETRY_STATUSES:
+                break
+        return self._failed(entries, error)
+
+    def post(self, body, headers):
+        """
+        POST ``body`` over the kept-alive connection. Returns the status and the response body.
+        """
+        if self._connection is None:
+            if self.endpoint.scheme == 'https':
+                self._connection = http.client.HTTPSConnection(self.endpoint.netloc, timeout=self.timeout)
+            else:
+                self._connection = http.client.HTTPConnection(self.endpoint.netloc, timeout=self.timeout)
+        self._connection.request('POST', self.endpoint.path.rstrip('/') + WRITE_PATH, body, headers)
+        response = self._connection.getresponse()
+        data = response.read()
+        if response.will_close:
+            self.close_connection()
+        return response.status, data
+
+    def close_connection(self):
+        if self._connection is not None:
+            self._connection.close()
+            self._connection = None
+
+    def _failed(self, entries, error):
+        self.failed += len(entries)
+        # Logging it would only queue it behind the batch that failed.
+        sys.stderr.write('Failed to send %d log entries to Cloud Logging: %s\n' % (len(entries), error))
+        return False
+
+    def close(self):
+        super(CloudLoggingHandler, self).close()
+        self.close_connection()
+
+    def _after_fork(self):
+        # The connection belongs to the parent.
+        self._connection = None
+        super(CloudLoggingHandler, self)._after_fork()
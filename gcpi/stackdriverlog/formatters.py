@@ -1,16 +1,15 @@
 # -*- coding: utf-8 -*-
 import re
 import json
-import traceback
 import time
-from collections import OrderedDict
-from datetime import date, datetime, time as dt_time
-from functools import partial
-from inspect import istraceback
 from itertools import chain
 
 from structlog.stdlib import ProcessorFormatter
-from structlog.processors import format_exc_info
+
+from gcpi.stackdriverlog.processors import format_exc_info
+from gcpi.stackdriverlog.serializers import (
+    BoundedBackend, SerializerBackend, default_handler, encode_isoformat, get_backend, json_default)
+from gcpi.stackdriverlog.timestamps import format_timestamp, split_timestamp
 
 # http://docs.python.org/library/logging.html#logrecord-attributes
 RESERVED_ATTRS = (
@@ -28,25 +27,10 @@ class JsonEncoder(json.JSONEncoder):
     https://github.com/madzak/python-json-logger/blob/master/src/pythonjsonlogger/jsonlogger.py
     """
     def default(self, obj):
-        if isinstance(obj, (date, datetime, dt_time)) or (
-                hasattr(obj, 'isoformat') and callable(obj.isoformat)):
+        handler = default_handler(type(obj))
+        if handler is encode_isoformat:
             return self.format_datetime_obj(obj)
-
-        elif istraceback(obj):
-            return ''.join(traceback.format_tb(obj)).strip()
-
-        elif type(obj) == (Exception or isinstance(obj, Exception) or type(obj) == type):
-            return str(obj)
-
-        try:
-            return super(JsonEncoder, self).default(obj)
-
-        except TypeError:
-            try:
-                return str(obj)
-
-            except Exception:
-                return None
+        return handler(obj)
 
     @staticmethod
     def format_datetime_obj(obj):
@@ -63,22 +47,62 @@ class JsonProcessorFormatter(ProcessorFormatter):
     :param json_encoder: optional custom encoder
     :param json_serializer: a :meth:`json.dumps`-compatible callable
       that will be used to serialize the log record.
+    :param json_backend: name of the JSON backend to use when no custom
+      serializer, encoder or default is given. One of ``'orjson'``,
+      ``'ujson'``, ``'json'`` or ``'auto'`` (default) for the fastest
+      one installed.
     :param prefix: an optional string prefix added at the beginning of
       the formatted string
+    :param timestamp_format: how the time of the record is written.
+      ``'rfc3339'`` (default) for a ``timestamp`` with nanoseconds,
+      ``'split'`` for ``timestampSeconds`` and ``timestampNanos``, or
+      None to leave it to Cloud Logging to use the time it received the entry.
+    :param max_bytes: approximate max size of a formatted record.
+    :param max_depth: depth below which nested containers are left out.
+    :param max_items: max number of items logged of each dict or list.
+    :param max_string_length: max length of the strings of the record,
+      but for the message and the exception.
+      Records over any of these limits are cut down before they are
+      serialized, see ``gcpi.stackdriverlog.serializers.BoundedBackend``.
     """
     default_time_format = '%Y-%m-%dT%H:%M:%S'
 
+    # Key is desired field name in the output, and value
+    # is a two tuple with the lookup attribute and either a function
+    # to run the value through or None.
+    field_aliases = {
+        'event': ('message', None),
+        'level': ('levelname', str.lower),
+        'logger': ('name', None),
+    }
+
+    # Record attributes that are never added as extra fields.
+    reserved_attrs = frozenset(RESERVED_ATTRS)
+
     def __init__(self, processor, foreign_pre_chain=None,
                  keep_exc_info=False, keep_stack_info=False, *args, **kwargs):
 
         self.json_default = kwargs.pop('json_default', None)
         self.json_encoder = kwargs.pop('json_encoder', None)
-        self.json_serializer = kwargs.pop('json_serializer', json.dumps)
+        self.json_serializer = kwargs.pop('json_serializer', None)
         self.json_indent = kwargs.pop('json_indent', None)
+        self.json_backend = kwargs.pop('json_backend', 'auto')
         self.prefix = kwargs.pop('prefix', '')
-
-        if not self.json_encoder and not self.json_default:
-            self.json_encoder = JsonEncoder
+        self.timestamp_format = kwargs.pop('timestamp_format', 'rfc3339')
+        if self.timestamp_format not in ('rfc3339', 'split', None):
+            raise ValueError("Invalid timestamp format: '%s'" % self.timestamp_format)
+        limits = {name: kwargs.pop(name, None) for name in ('max_bytes', 'max_depth', 'max_items', 'max_string_length')}
+
+        if self.json_serializer or self.json_encoder or self.json_default:
+            if not self.json_encoder and not self.json_default:
+                self.json_encoder = JsonEncoder
+            self.backend = SerializerBackend(self.json_serializer or json.dumps, default=self.json_default,
+                                             cls=self.json_encoder, indent=self.json_indent)
+        else:
+            self.backend = get_backend(self.json_backend, indent=self.json_indent)
+
+        if any(limit is not None for limit in limits.values()):
+            self.backend = BoundedBackend(self.backend, default=self.json_default or json_default, **limits)
 
         # Default to UTC timestamps
         self.converter = kwargs.pop('converter', time.gmtime)
@@ -88,44 +112,54 @@ class JsonProcessorFormatter(ProcessorFormatter):
         super(JsonProcessorFormatter, self).__init__(processor, foreign_pre_chain,
                                                      keep_exc_info, keep_stack_info, *args, **kwargs)
 
+        self._field_plan = self.build_field_plan()
+
     @property
     def required_fields(self):
+        return self._required_fields
+
+    def build_field_plan(self):
+        """
+        Work out the output keys, lookup attributes and transforms
+        once, so that formatting a record only has to run the plan.
+        """
         pattern = re.compile(r'\((.+?)\)', re.IGNORECASE)
-        return set(chain(pattern.findall(self._fmt), ['level', 'logger', 'timestamp']))
+        self._required_fields = frozenset(chain(pattern.findall(self._fmt), ['level', 'logger', 'timestamp']))
+
+        plan = []
+        for field in sorted(self._required_fields):
+            # The timestamp is set from ``record.created`` by ``add_fields``.
+            if field == 'timestamp':
+                continue
+            alias, proc = self.field_aliases.get(field, (None, None))
+            plan.append((field, alias or field, proc))
+        return tuple(plan)
 
     def add_fields(self, record, messages):
         """
         Add all required fields to the log record.
         """
-        # Key is desired field name in the output, and value
-        # is a two tuple with the lookup attribute and either a function
-        # to run the value through or None. If not value is found and a function
-        # is provided it wil be called without any arguments.
-        field_aliases = {
-            'event': ('message', None),
-            'level': ('levelname', str.lower),
-            'logger': ('name', None),
-            'timestamp': (None, partial(self.formatTime, record=record, datefmt=self.datefmt))
-        }
-
-        log_record = OrderedDict()
-        for field in self.required_fields:
-            alias, proc = field_aliases.get(field, (None, None))
-            value = record.__dict__.get(alias or field)
+        attrs = record.__dict__
+        log_record = {}
+        for field, attr, proc in self._field_plan:
+            value = attrs.get(attr)
             if value:
                 log_record[field] = proc(value) if proc else value
-            elif proc:
-                log_record[field] = proc()
 
         log_record.update(messages)
-        for key, value in record.__dict__.items():
-            if key not in RESERVED_ATTRS and not (hasattr(key, 'startswith') and key.startswith('_')):
+        reserved = self.reserved_attrs
+        for key, value in attrs.items():
+            if key not in reserved and not key.startswith('_'):
                 log_record[key] = value
 
-        log_record['severity'] = log_record.pop('level','info').upper()
-        if not 'message' in log_record:
+        log_record['severity'] = log_record.pop('level', 'info').upper()
+        if 'message' not in log_record:
             log_record['message'] = log_record.get('event')
         log_record.pop('timestamp', None)
+        if self.timestamp_format == 'rfc3339':
+            log_record['timestamp'] = format_timestamp(record.created)
+        elif self.timestamp_format == 'split':
+            log_record['timestampSeconds'], log_record['timestampNanos'] = split_timestamp(record.created)
 
         return log_record
 
@@ -134,6 +168,20 @@ class JsonProcessorFormatter(ProcessorFormatter):
         Converts the log records message to a dictionary and
         pass it on to the ``structlog.stdlib.ProcessorFormatter`` to
         do its magic.
+
+        Records coming from structlog through
+        ``ProcessorFormatter.wrap_for_formatter`` already carry the
+        event dictionary, and are serialized directly without going
+        through ``structlog.stdlib.ProcessorFormatter``.
+        """
+        if self.from_structlog(record):
+            return self.format_event_dict(record)
+        return self.format_record(record)
+
+    def format_record(self, record):
+        """
+        Format a record that doesn't come from structlog, with a JSON
+        rendered or plain text message.
         """
         # Make sure message always is a dictionary
         message = record.getMessage()
@@ -144,18 +192,53 @@ class JsonProcessorFormatter(ProcessorFormatter):
 
         # Format exceptions to JSON and set `exc_info` to None in order
         # to avoid the stdlib logger to write it out.
-        if record.exc_info and 'exc_info' not in message:
-            message.update(**format_exc_info(
-                None, record.levelname,
-                {'exc_info': record.exc_info, 'event': record.getMessage()}
-            ))
-            record.exc_info = None
+        self.add_exc_info(record, message)
+        record.exc_info = None
 
-        record.msg = self.json_serializer(self.add_fields(record, message), default=self.json_default,
-                                          cls=self.json_encoder, indent=self.json_indent)
+        record.msg = self.backend.dumps(self.add_fields(record, message))
 
         # We're done formatting the `record.msg` attribute.
         # Need to delete `record.args` so that `record.getMessage()`
         # don't raise any errors.
         record.args = ()
         return super(JsonProcessorFormatter, self).format(record)
+
+    def format_event_dict(self, record):
+        """
+        Serialize a structlog event dictionary passed on by
+        ``ProcessorFormatter.wrap_for_formatter`` in a single pass.
+
+        The record is left untouched so that other handlers can
+        format it as well.
+        """
+        return self.backend.dumps(self.event_dict_fields(record))
+
+    def format_bytes(self, record):
+        """
+        Like :meth:`format`, but returns UTF-8 encoded bytes. Records
+        from structlog are serialized straight to bytes.
+        """
+        if self.from_structlog(record):
+            return self.backend.dumpb(self.event_dict_fields(record))
+        return self.format_record(record).encode('utf-8')
+
+    @staticmethod
+    def from_structlog(record):
+        """
+        True if the record was passed on by ``ProcessorFormatter.wrap_for_formatter``.
+        """
+        return isinstance(record.msg, dict) and hasattr(record, '_logger')
+
+    def event_dict_fields(self, record):
+        message = record.msg.copy()
+        self.add_exc_info(record, message)
+        return self.add_fields(record, message)
+
+    @staticmethod
+    def add_exc_info(record, message):
+        """
+        Format the records exception into the message, unless structlog
+        already did so.
+        """
+        if record.exc_info and 'exc_info' not in message and 'exception' not in message:
+            message.update(**format_exc_info(None, record.levelname, {'exc_info': record.exc_info}))
@@ -0,0 +1,251 @@
+# -*- coding: utf-8 -*-
+import codecs
+import logging
+import os
+import queue
+import signal
+import threading
+import time
+import weakref
+
+
+class StreamHandler(logging.StreamHandler):
+    """
+    A ``logging.StreamHandler`` that writes bytes straight to the binary
+    buffer of the stream, when the formatter can render records as bytes
+    (like ``JsonProcessorFormatter`` does) and the stream is UTF-8 encoded.
+    Anything else is written like ``logging.StreamHandler`` does.
+    """
+    def __init__(self, stream=None):
+        super(StreamHandler, self).__init__(stream)
+        self._buffer_for = (None, None)
+
+    def binary_buffer(self):
+        """
+        Returns the binary buffer of the current stream, or None
+        if bytes can't be written to it.
+        """
+        stream, buffer = self._buffer_for
+        if stream is not self.stream:
+            stream, buffer = self.stream, getattr(self.stream, 'buffer', None)
+            try:
+                if codecs.lookup(stream.encoding).name != 'utf-8':
+                    buffer = None
+            except (AttributeError, LookupError, TypeError):
+                buffer = None
+            self._buffer_for = (stream, buffer)
+        return buffer
+
+    def emit(self, record):
+        try:
+            format_bytes = getattr(self.formatter, 'format_bytes', None)
+            buffer = self.binary_buffer() if format_bytes is not None else None
+            if buffer is not None:
+                data = format_bytes(record) + self.terminator.encode('utf-8')
+            else:
+                data = self.format(record) + self.terminator
+            self.write(data, buffer)
+        except RecursionError:
+            raise
+        except Exception:
+            self.handleError(record)
+
+    def write(self, data, buffer=None):
+        """
+        Write formatted records to the stream, or as bytes to its ``buffer``.
+        """
+        if buffer is not None:
+            # Flush what's been written to the text layer of the stream
+            # first, so that the output stays in order.
+            self.stream.flush()
+            buffer.write(data)
+            buffer.flush()
+        else:
+            self.stream.write(data)
+            self.stream.flush()
+
+
+class QueuedHandler(logging.Handler):
+    """
+    Base of the handlers that never let the logging thread wait on I/O.
+
+    Records are put on a bounded queue, and a single background thread
+    takes them off it in ``_run``. When the queue is full, records are
+    either dropped and counted in ``dropped`` (``overflow='drop'``), or the
+    logging thread waits for room (``overflow='block'``).
+
+    The queue is drained when the handler is closed, which ``logging`` does
+    at exit, and when the process receives SIGTERM. Subclasses set their
+    own attributes before calling ``__init__``, which starts the thread.
+    """
+    thread_name = 'gcpi-log-writer'
+
+    # Seconds ``close`` waits for the thread to finish.
+    close_timeout = 5.0
+
+    # Put on the queue by ``close`` to stop the thread.
+    STOP = object()
+
+    def __init__(self, *args, queue_size=10000, overflow='drop', **kwargs):
+        if overflow not in ('drop', 'block'):
+            raise ValueError("Invalid overflow policy: '%s'" % overflow)
+
+        super(QueuedHandler, self).__init__(*args, **kwargs)
+        self.queue_size = queue_size
+        self.overflow = overflow
+        self.dropped = 0
+        self._start()
+
+        _queued_handlers.add(self)
+        _install_sigterm_handler()
+
+    def _start(self):
+        self.queue = queue.Queue(self.queue_size)
+        self._thread = threading.Thread(target=self._run, name=self.thread_name, daemon=True)
+        self._thread.start()
+
+    def emit(self, record):
+        # Called with the handler lock held, so counting is safe.
+        if self.overflow == 'block':
+            self.queue.put(record)
+            return
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+    def _run(self):
+        """
+        Take records off ``self.queue``, marking each done, until ``STOP``.
+        """
+        raise NotImplementedError
+
+    def drain(self, timeout=5.0):
+        """
+        Wait up to ``timeout`` seconds for the queued records to be handled.
+        """
+        deadline = time.monotonic() + timeout
+        while self.queue.unfinished_tasks and self._thread.is_alive() and time.monotonic() < deadline:
+            time.sleep(0.001)
+
+    def flush(self):
+        self.drain(self.close_timeout)
+
+    def close(self):
+        if self._thread.is_alive():
+            try:
+                self.queue.put(self.STOP, timeout=5.0)
+            except queue.Full:
+                pass
+            self._thread.join(self.close_timeout)
+        _queued_handlers.discard(self)
+        super(QueuedHandler, self).close()
+
+    def _after_fork(self):
+        # The thread doesn't survive a fork, and the queue lock might
+        # have been held by it. Records queued in the parent are
+        # handled by the parent.
+        self._start()
+
+
+class AsyncStreamHandler(QueuedHandler, StreamHandler):
+    """
+    A ``QueuedHandler`` whose thread formats and writes records to the
+    stream in batches of up to ``batch_size``.
+    """
+    def __init__(self, stream=None, queue_size=10000, overflow='drop', batch_size=256):
+        self.batch_size = batch_size
+        super(AsyncStreamHandler, self).__init__(stream, queue_size=queue_size, overflow=overflow)
+
+    def _run(self):
+        q = self.queue
+        while True:
+            batch = [q.get()]
+            while len(batch) < self.batch_size:
+                try:
+                    batch.append(q.get_nowait())
+                except queue.Empty:
+                    break
+
+            stop = any(record is self.STOP for record in batch)
+            self.write_batch([record for record in batch if record is not self.STOP])
+            for _ in batch:
+                q.task_done()
+            if stop:
+                return
+
+    def write_batch(self, records):
+        """
+        Format ``records`` and write them to the stream with a single write.
+        """
+        if not records:
+            return
+
+        format_bytes = getattr(self.formatter, 'format_bytes', None)
+        buffer = self.binary_buffer() if format_bytes is not None else None
+        if buffer is not None:
+            fmt, terminator = format_bytes, self.terminator.encode('utf-8')
+        else:
+            fmt, terminator = self.format, self.terminator
+
+        chunks = []
+        for record in records:
+            try:
+                chunks.append(fmt(record) + terminator)
+            except RecursionError:
+                raise
+            except Exception:
+                self.handleError(record)
+
+        try:
+            self.write((b'' if buffer is not None else '').join(chunks), buffer)
+        except RecursionError:
+            raise
+        except Exception:
+            self.handleError(records[-1])
+
+
+_queued_handlers = weakref.WeakSet()
+_sigterm_handler_installed = False
+_previous_sigterm_handler = None
+
+
+def queued_handlers():
+    """
+    Returns the ``QueuedHandler`` instances that are open.
+    """
+    return list(_queued_handlers)
+
+
+def _after_fork_in_child():
+    for handler in queued_handlers():
+        handler._after_fork()
+
+
+def _sigterm_handler(signum, frame):
+    for handler in queued_handlers():
+        handler.drain()
+
+    previous = _previous_sigterm_handler
+    if callable(previous):
+        previous(signum, frame)
+    elif previous is not signal.SIG_IGN:
+        # Terminate the same way as we would have without our handler.
+        signal.signal(signum, signal.SIG_DFL)
+        os.kill(os.getpid(), signum)
+
+
+def _install_sigterm_handler():
+    global _sigterm_handler_installed, _previous_sigterm_handler
+    if _sigterm_handler_installed:
+        return
+    try:
+        _previous_sigterm_handler = signal.signal(signal.SIGTERM, _sigterm_handler)
+        _sigterm_handler_installed = True
+    except ValueError:
+        # Signal handlers can only be installed from the main thread.
+        pass
+
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_after_fork_in_child)
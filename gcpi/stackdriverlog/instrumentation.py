@@ -0,0 +1,176 @@
+# -*- coding: utf-8 -*-
+"""
+Counters of where the time spent logging goes.
+
+Instrumentation is off by default and costs nothing then: :func:`enable`
+replaces the methods it measures with timed ones, on their classes, the
+same way ``gcpi.stackdriverlog.levels`` turns off disabled levels, and
+:func:`disable` puts the originals back.
+
+Counters are updated without a lock, so a few updates can get lost when
+threads log at the same time.
+"""
+import functools
+import time
+
+import structlog
+
+from gcpi.stackdriverlog.exporters import CloudLoggingHandler
+from gcpi.stackdriverlog.formatters import JsonProcessorFormatter
+from gcpi.stackdriverlog.handlers import StreamHandler, queued_handlers
+from gcpi.stackdriverlog.levels import FilteringBoundLogger
+from gcpi.stackdriverlog.processors import SamplingProcessor
+
+
+class Counters:
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        # Records formatted, per level name.
+        self.records = {}
+        # Bytes written, or characters for text streams.
+        self.bytes = 0
+        # Nanoseconds spent in the structlog processors, which include the
+        # JSON renderer unless NATIVE_RENDERING is set, in the formatter,
+        # and in writing to the stream or the Cloud Logging API.
+        self.processors_ns = 0
+        self.serialization_ns = 0
+        self.write_ns = 0
+        self.started = time.monotonic()
+
+
+counters = Counters()
+
+# Seconds between the reports logged by the instrumented loggers, or None.
+report_interval = None
+_next_report = None
+
+# Methods replaced by ``enable``, by (class, method name). None
+# for methods the class inherited.
+_originals = {}
+
+
+def timed_process_event(process_event):
+    @functools.wraps(process_event)
+    def wrapper(self, method_name, event, event_kw):
+        start = time.perf_counter_ns()
+        try:
+            return process_event(self, method_name, event, event_kw)
+        finally:
+            counters.processors_ns += time.perf_counter_ns() - start
+            if _next_report is not None and time.monotonic() >= _next_report:
+                log_report()
+    return wrapper
+
+
+def timed_format(format):
+    @functools.wraps(format)
+    def wrapper(self, record):
+        start = time.perf_counter_ns()
+        try:
+            return format(self, record)
+        finally:
+            counters.serialization_ns += time.perf_counter_ns() - start
+            records = counters.records
+            records[record.levelname] = records.get(record.levelname, 0) + 1
+    return wrapper
+
+
+def timed_write(write):
+    @functools.wraps(write)
+    def wrapper(self, data, *args, **kwargs):
+        start = time.perf_counter_ns()
+        try:
+            return write(self, data, *args, **kwargs)
+        finally:
+            counters.write_ns += time.perf_counter_ns() - start
+            counters.bytes += len(data)
+    return wrapper
+
+
+# Methods timed while instrumentation is enabled. ``format`` and
+# ``format_bytes`` don't call each other, so no record is counted twice.
+INSTRUMENTED = (
+    (FilteringBoundLogger, '_process_event', timed_process_event),
+    (JsonProcessorFormatter, 'format', timed_format),
+    (JsonProcessorFormatter, 'format_bytes', timed_format),
+    (StreamHandler, 'write', timed_write),
+    (CloudLoggingHandler, 'post', timed_write),
+)
+
+
+def enable(interval=None):
+    """
+    Start counting. With ``interval``, a report of the counters is logged
+    every ``interval`` seconds, with the first event after it has passed.
+    """
+    global report_interval, _next_report
+    for cls, name, timed in INSTRUMENTED:
+        if (cls, name) not in _originals:
+            _originals[cls, name] = cls.__dict__.get(name)
+            setattr(cls, name, timed(getattr(cls, name)))
+
+    report_interval = interval
+    _next_report = time.monotonic() + interval if interval else None
+
+
+def disable():
+    """
+    Stop counting and restore the original methods.
+    """
+    global report_interval, _next_report
+    for (cls, name), original in _originals.items():
+        if original is None:
+            delattr(cls, name)
+        else:
+            setattr(cls, name, original)
+    _originals.clear()
+    report_interval = _next_report = None
+
+
+def is_enabled():
+    return bool(_originals)
+
+
+def stats():
+    """
+    Returns the counters, and the number of records dropped, sampled out,
+    suppressed by rate limiting or that failed to be sent. Those are
+    counted even when instrumentation is disabled.
+    """
+    dropped = failed = 0
+    for handler in queued_handlers():
+        dropped += handler.dropped
+        failed += getattr(handler, 'failed', 0)
+
+    sampled = suppressed = 0
+    for processor in structlog.get_config()['processors']:
+        if isinstance(processor, SamplingProcessor):
+            sampled += processor.sampled
+            suppressed += processor.suppressed
+
+    return {
+        'enabled': is_enabled(),
+        'seconds': round(time.monotonic() - counters.started, 3),
+        'records': dict(counters.records),
+        'bytes': counters.bytes,
+        'processors_ms': round(counters.processors_ns / 1e6, 3),
+        'serialization_ms': round(counters.serialization_ns / 1e6, 3),
+        'write_ms': round(counters.write_ns / 1e6, 3),
+        'dropped': dropped,
+        'sampled': sampled,
+        'suppressed': suppressed,
+        'failed': failed,
+    }
+
+
+def log_report(logger=None):
+    """
+    Logs :func:`stats` as a single structured line.
+    """
+    global _next_report
+    if report_interval:
+        _next_report = time.monotonic() + report_interval
+    logger = logger or structlog.get_logger(__name__)
+    logger.info('logging stats', event_type='logging_stats', stats=stats())
@@ -0,0 +1,109 @@
+# -*- coding: utf-8 -*-
+"""
+Bound loggers that don't do anything for levels no logger is enabled for.
+
+``structlog.stdlib.filter_by_level`` only drops an event after structlog
+has built the event dict and started running the processors. Methods of
+``FilteringBoundLogger`` below the lowest level enabled on any stdlib
+logger are replaced by empty functions instead. They are swapped on the
+class, so loggers that are already bound and cached pick up changes.
+
+Levels changed at runtime are picked up too: ``Logger.setLevel`` and
+``logging.disable`` clear the cache of the logging manager, which
+:func:`install_level_hook` hooks to call :func:`update_min_level`. The
+hook is only installed when the settings configure structlog with
+``FilteringBoundLogger``, importing this module changes nothing.
+"""
+import functools
+import logging
+
+import structlog
+
+# Level of each structlog method.
+METHOD_LEVELS = {
+    'debug': logging.DEBUG,
+    'info': logging.INFO,
+    'warning': logging.WARNING,
+    'warn': logging.WARNING,
+    'error': logging.ERROR,
+    'exception': logging.ERROR,
+    'critical': logging.CRITICAL,
+    'fatal': logging.CRITICAL,
+}
+
+
+def _disabled(self, event=None, *args, **kw):
+    return None
+
+
+async def _adisabled(self, event=None, *args, **kw):
+    return None
+
+
+class FilteringBoundLogger(structlog.stdlib.BoundLogger):
+    """
+    A ``structlog.stdlib.BoundLogger`` whose methods below ``min_level``
+    do nothing.
+    """
+    min_level = logging.NOTSET
+
+
+def lowest_level():
+    """
+    Returns the lowest level any stdlib logger would let through.
+    """
+    levels = [logging.root.level]
+    for logger in logging.root.manager.loggerDict.values():
+        if isinstance(logger, logging.Logger) and logger.level != logging.NOTSET:
+            levels.append(logger.level)
+    # Everything at or below ``logging.disable`` is dropped.
+    return max(min(levels), logging.root.manager.disable + 1)
+
+
+def set_min_level(level):
+    """
+    Turn the methods of ``FilteringBoundLogger`` below ``level`` into empty functions,
+    and restore the others.
+    """
+    for name, method_level in METHOD_LEVELS.items():
+        for method_name, disabled in ((name, _disabled), ('a' + name, _adisabled)):
+            if not hasattr(structlog.stdlib.BoundLogger, method_name):
+                continue
+            if method_level < level:
+                setattr(FilteringBoundLogger, method_name, disabled)
+            elif method_name in FilteringBoundLogger.__dict__:
+                delattr(FilteringBoundLogger, method_name)
+    FilteringBoundLogger.min_level = level
+
+
+def update_min_level():
+    """
+    Update ``FilteringBoundLogger`` after stdlib logger levels have changed.
+    """
+    set_min_level(lowest_level())
+
+
+def set_level(level, name=None):
+    """
+    Set the level of the stdlib logger ``name``, or the root logger.
+    ``FilteringBoundLogger`` is updated by the hook below.
+    """
+    logging.getLogger(name).setLevel(level)
+
+
+def _updating_min_level(clear_cache):
+    @functools.wraps(clear_cache)
+    def wrapper(self):
+        clear_cache(self)
+        update_min_level()
+    wrapper._updates_min_level = True
+    return wrapper
+
+
+def install_level_hook():
+    """
+    Have every change of level on a stdlib logger, which clears the cache
+    of the logging manager, update ``FilteringBoundLogger``. Installed once.
+    """
+    if not getattr(logging.Manager._clear_cache, '_updates_min_level', False):
+        logging.Manager._clear_cache = _updating_min_level(logging.Manager._clear_cache)
@@ -4,6 +4,7 @@ import logging.config
 import structlog
 
 from gcpi.stackdriverlog.conf import settings
+from gcpi.stackdriverlog.processors import format_exc_info
 
 
 class StackDriverLogger(logging.Logger):
@@ -16,7 +17,7 @@ class StackDriverLogger(logging.Logger):
             structlog.stdlib.filter_by_level,
             structlog.stdlib.PositionalArgumentsFormatter(),
             structlog.processors.StackInfoRenderer(),
-            structlog.processors.format_exc_info,
+            format_exc_info,
             structlog.processors.JSONRenderer(sort_keys=True),
             structlog.stdlib.ProcessorFormatter.wrap_for_formatter,
         ]
@@ -0,0 +1,155 @@
+# -*- coding: utf-8 -*-
+"""
+In-process request latency histograms, kept by the request logging
+middleware per (route, method, status).
+"""
+import threading
+import time
+
+import structlog
+
+# Each power of two is split in 2 ** SUB_BUCKET_BITS buckets, so a
+# percentile is off by at most 1 / 2 ** SUB_BUCKET_BITS (about 6%).
+SUB_BUCKET_BITS = 4
+
+# Key of the latencies of routes past the ``max_keys`` of a ``LatencyRecorder``.
+OTHER_ROUTE = '<other>'
+
+
+def bucket_of(value):
+    """
+    Returns the log bucket of a positive integer.
+    """
+    bits = value.bit_length()
+    if bits <= SUB_BUCKET_BITS + 1:
+        return value
+    shift = bits - SUB_BUCKET_BITS - 1
+    return (shift << SUB_BUCKET_BITS) + (value >> shift)
+
+
+def bucket_upper_bound(bucket):
+    """
+    Returns the largest value of a log bucket.
+    """
+    if bucket < 2 << SUB_BUCKET_BITS:
+        return bucket
+    shift = (bucket >> SUB_BUCKET_BITS) - 1
+    return ((bucket - (shift << SUB_BUCKET_BITS) + 1) << shift) - 1
+
+
+class LatencyHistogram:
+    """
+    Histogram of durations in nanoseconds, in fixed log buckets.
+    """
+    __slots__ = ('buckets', 'count', 'total', 'max')
+
+    def __init__(self):
+        self.buckets = {}
+        self.count = 0
+        self.total = 0
+        self.max = 0
+
+    def record(self, duration_ns):
+        bucket = bucket_of(max(duration_ns, 1))
+        self.buckets[bucket] = self.buckets.get(bucket, 0) + 1
+        self.count += 1
+        self.total += duration_ns
+        if duration_ns > self.max:
+            self.max = duration_ns
+
+    def percentiles(self, *shares):
+        """
+        Returns the upper bounds of the buckets holding the given
+        percentiles, from 0.0 to 1.0, in nanoseconds.
+        """
+        results = []
+        counts = sorted(self.buckets.items())
+        index, seen = 0, 0
+        for share in shares:
+            rank = max(1, round(share * self.count))
+            while seen < rank and index < len(counts):
+                seen += counts[index][1]
+                index += 1
+            results.append(min(bucket_upper_bound(counts[index - 1][0]), self.max) if counts else 0)
+        return results
+
+    def summary(self):
+        p50, p95, p99 = self.percentiles(0.50, 0.95, 0.99)
+        return {
+            'count': self.count,
+            'mean_ms': round(self.total / self.count / 1e6, 3) if self.count else 0.0,
+            'p50_ms': round(p50 / 1e6, 3),
+            'p95_ms': round(p95 / 1e6, 3),
+            'p99_ms': round(p99 / 1e6, 3),
+            'max_ms': round(self.max / 1e6, 3),
+        }
+
+
+class LatencyRecorder:
+    """
+    Latency histograms per (route, method, status).
+
+    :param snapshot_interval: seconds between the snapshots logged with the
+      first request after the interval has passed, or None to only take
+      snapshots when :meth:`log_snapshot` is called.
+    :param max_keys: max number of (route, method, status) keys. Routes
+      past it are recorded as ``OTHER_ROUTE``.
+    """
+    def __init__(self, snapshot_interval=None, max_keys=1000):
+        self.max_keys = max_keys
+        self._histograms = {}
+        self._lock = threading.Lock()
+        self.set_snapshot_interval(snapshot_interval)
+
+    def set_snapshot_interval(self, snapshot_interval):
+        self.snapshot_interval = snapshot_interval
+        self._next_snapshot = time.monotonic() + snapshot_interval if snapshot_interval else None
+
+    def record(self, route, method, status, duration_ns):
+        key = (route, method, status)
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                if len(self._histograms) >= self.max_keys:
+                    key = (OTHER_ROUTE, method, status)
+                    histogram = self._histograms.get(key)
+                if histogram is None:
+                    histogram = self._histograms[key] = LatencyHistogram()
+            histogram.record(duration_ns)
+
+            snapshot_due = self._next_snapshot is not None and time.monotonic() >= self._next_snapshot
+            if snapshot_due:
+                self._next_snapshot = time.monotonic() + self.snapshot_interval
+        if snapshot_due:
+            self.log_snapshot()
+
+    def snapshot(self, reset=True):
+        """
+        Returns the summary of each histogram. With ``reset``, the
+        histograms start over, so that each snapshot covers an interval.
+        """
+        with self._lock:
+            histograms = self._histograms
+            if reset:
+                self._histograms = {}
+            else:
+                histograms = dict(histograms)
+
+        return [
+            dict(route=route, method=method, status=status, **histogram.summary())
+            for (route, method, status), histogram in sorted(histograms.items(), key=lambda item: str(item[0]))
+        ]
+
+    def log_snapshot(self, logger=None, reset=True):
+        """
+        Logs a snapshot as a single structured line.
+        """
+        latencies = self.snapshot(reset)
+        if latencies:
+            logger = logger or structlog.get_logger(__name__)
+            logger.info('request latency', event_type='request_latency', latencies=latencies)
+        return latencies
+
+
+# Shared by the request logging middlewares.
+request_latency = LatencyRecorder()
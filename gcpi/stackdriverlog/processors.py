@@ -0,0 +1,543 @@
+# -*- coding: utf-8 -*-
+"""
+structlog processors installed by ``gcpi.stackdriverlog.conf.Settings``.
+"""
+import atexit
+import builtins
+import hashlib
+import os
+import random
+import re
+import sys
+import threading
+import time
+import traceback
+import weakref
+from collections import OrderedDict
+
+import structlog
+from structlog.exceptions import DropEvent
+
+from gcpi.stackdriverlog.context import trace_context
+
+# Level names used for sampling, by structlog method name.
+METHOD_LEVELS = {
+    'exception': 'error',
+    'warn': 'warning',
+    'fatal': 'critical',
+    'msg': 'info',
+}
+
+
+def _flush_summaries_at_exit(ref):
+    processor = ref()
+    if processor is not None:
+        processor.flush_summaries()
+
+
+class SamplingProcessor:
+    """
+    Drops events before they are rendered, either by head sampling or by
+    rate limiting. Should run right after ``structlog.stdlib.filter_by_level``,
+    so that dropped events cost next to nothing.
+
+    :param rates: logger names or level names mapped to the share of their
+      events to keep, from 0.0 to 1.0. Logger names take precedence.
+    :param rate_limit: events per second allowed for each (logger, event)
+      pair, or None to not rate limit.
+    :param burst: number of events allowed in a burst for each pair.
+      Defaults to ``rate_limit``, and is at least 1.
+    :param summary_interval: seconds between the warnings logged with the
+      number of events suppressed by the rate limit. Summaries are logged
+      with the first event of any kind after the interval has passed, and
+      at exit.
+    :param max_keys: max number of (logger, event) pairs to track.
+    """
+    def __init__(self, rates=None, rate_limit=None, burst=None, summary_interval=60.0, max_keys=10000):
+        if rate_limit is not None and rate_limit <= 0:
+            raise ValueError("Invalid rate limit: '%s'" % rate_limit)
+        self.rates = dict(rates or {})
+        self.rate_limit = rate_limit
+        # A bucket must hold at least one token, or nothing would ever pass.
+        self.burst = max(burst or rate_limit, 1) if rate_limit is not None else None
+        self.summary_interval = summary_interval
+        self.max_keys = max_keys
+
+        # Number of events dropped by sampling and by rate limiting.
+        self.sampled = 0
+        self.suppressed = 0
+
+        self._buckets = {}
+        self._pending = {}
+        self._next_summary = time.monotonic() + summary_interval
+        self._lock = threading.Lock()
+        self._local = threading.local()
+
+        if rate_limit is not None:
+            # Log what's still pending at exit, as no event may come to trigger it.
+            atexit.register(_flush_summaries_at_exit, weakref.ref(self))
+
+    def __call__(self, logger, method_name, event_dict):
+        # Let the summaries we log ourselves through.
+        if getattr(self._local, 'summarizing', False):
+            return event_dict
+
+        # Summaries are due whatever the key of the event, and even if
+        # it's dropped by sampling.
+        if self._pending and time.monotonic() >= self._next_summary:
+            self.flush_summaries()
+
+        name = getattr(logger, 'name', None)
+        if self.rates:
+            rate = self.rates.get(name)
+            if rate is None:
+                rate = self.rates.get(METHOD_LEVELS.get(method_name, method_name))
+            if rate is not None and random.random() >= rate:
+                self.sampled += 1
+                raise DropEvent
+
+        if self.rate_limit is not None:
+            event = event_dict.get('event')
+            if not isinstance(event, str):
+                event = str(event_dict.get('message'))
+            self.limit((name, event))
+        return event_dict
+
+    def limit(self, key):
+        """
+        Take a token from the bucket of ``key``, or raise ``DropEvent``.
+        """
+        now = time.monotonic()
+        with self._lock:
+            allowed = self.take(key, now)
+            if not allowed:
+                self.suppressed += 1
+                self._pending[key] = self._pending.get(key, 0) + 1
+        if not allowed:
+            raise DropEvent
+
+    def flush_summaries(self):
+        """
+        Log the number of events suppressed since the last summaries.
+        """
+        with self._lock:
+            self._next_summary = time.monotonic() + self.summary_interval
+            pending, self._pending = self._pending, {}
+        if pending:
+            self.log_summary(pending)
+
+    def take(self, key, now):
+        bucket = self._buckets.get(key)
+        if bucket is None:
+            if len(self._buckets) >= self.max_keys:
+                self._buckets.clear()
+            self._buckets[key] = [self.burst - 1, now]
+            return True
+
+        tokens = min(self.burst, bucket[0] + (now - bucket[1]) * self.rate_limit)
+        bucket[1] = now
+        if tokens >= 1:
+            bucket[0] = tokens - 1
+            return True
+        bucket[0] = tokens
+        return False
+
+    def log_summary(self, pending):
+        self._local.summarizing = True
+        try:
+            for (name, event), count in pending.items():
+                structlog.get_logger(name).warning(
+                    f'suppressed {count} similar events', suppressed=count, suppressed_event=event)
+        finally:
+            self._local.summarizing = False
+
+
+# Special fields Cloud Logging reads the trace of an entry from.
+TRACE_KEY = 'logging.googleapis.com/trace'
+SPAN_ID_KEY = 'logging.googleapis.com/spanId'
+TRACE_SAMPLED_KEY = 'logging.googleapis.com/trace_sampled'
+
+
+class TraceContextProcessor:
+    """
+    Adds the trace and request id of the current request, kept in
+    ``gcpi.stackdriverlog.context.trace_context``, to every event. Loggers
+    don't need to be bound to the request for their events to be correlated.
+
+    :param project: project the traces belong to, used to build the full
+      trace resource name. Defaults to the GOOGLE_CLOUD_PROJECT environment
+      variable. Without a project, the bare trace id is logged.
+    """
+    def __init__(self, project=None):
+        project = project or os.environ.get('GOOGLE_CLOUD_PROJECT')
+        self.trace_prefix = f'projects/{project}/traces/' if project else ''
+
+    def __call__(self, logger, method_name, event_dict):
+        context = trace_context.get()
+        if context is None:
+            return event_dict
+
+        if context.trace_id is not None:
+            event_dict.setdefault(TRACE_KEY, self.trace_prefix + context.trace_id)
+            if context.span_id is not None:
+                event_dict.setdefault(SPAN_ID_KEY, context.span_id)
+            event_dict.setdefault(TRACE_SAMPLED_KEY, context.sampled)
+        if context.request_id is not None:
+            event_dict.setdefault('request_id', context.request_id)
+        return event_dict
+
+
+# Values redacted by ``RedactionProcessor``, by name. Card numbers are
+# only redacted if their check digit is right.
+REDACTED_VALUES = {
+    'email': r'(?<![\w.+-])[\w.+-]{1,64}@[\w-]{1,63}(?:\.[\w-]{1,63})+',
+    'bearer': r'\b[Bb]earer\s+[\w.~+/-]+=*',
+    'card': r'\b(?:\d[ -]?){12,18}\d\b',
+}
+
+# Keys whose values are never redacted or searched.
+UNREDACTED_KEYS = frozenset((
+    'logger', 'level', 'request_id', 'exception_fingerprint', TRACE_KEY, SPAN_ID_KEY, TRACE_SAMPLED_KEY,
+))
+
+# Values that can't hold secrets.
+_PLAIN_TYPES = frozenset((int, float, bool, type(None)))
+
+# Word boundaries in camelCase keys, including after acronyms like 'HTTPAuth'.
+_CAMEL_CASE = re.compile(r'(?<=[a-z0-9])(?=[A-Z])|(?<=[A-Z])(?=[A-Z][a-z])')
+
+# Decisions of ``RedactionProcessor`` per key.
+_SEARCH, _REDACT, _KEEP, _REDACT_STRINGS = 0, 1, 2, 3
+
+
+def luhn_valid(number):
+    """
+    True if the digits in ``number`` have a valid Luhn check digit.
+    """
+    digits = [int(c) for c in number if c.isdigit()]
+    total = sum(digits[-1::-2]) + sum(d * 2 - 9 if d > 4 else d * 2 for d in digits[-2::-2])
+    return total % 10 == 0
+
+
+class RedactionProcessor:
+    """
+    Redacts secrets anywhere in the event dict, in nested dicts, lists and
+    tuples too. Nested containers are copied when something in them is
+    redacted, never changed.
+
+    The values of sensitive keys are replaced as a whole. Keys are matched
+    case insensitively, camelCase ones split into words. Keys equal to a
+    sensitive key, or to its plural, have any value replaced. Keys containing
+    one as a word, like 'access_token', 'accessToken', 'X-Token' and
+    'auth_tokens' for 'token' but not 'tokenizer', only have string values
+    replaced, so that 'token_count' numbers and 'password_reset_enabled'
+    flags are kept. Sensitive parts of other strings, like email addresses,
+    are replaced where they are found, with a single combined regular
+    expression.
+
+    The dict is walked once. The decision made for each key is cached, and
+    so is the outcome of searching strings up to ``max_cached_length``
+    characters long, as messages and most values repeat.
+
+    :param keys: sensitive key names.
+    :param values: names of ``REDACTED_VALUES``, or regular expressions,
+      to redact from strings.
+    :param replacement: what secrets are replaced with.
+    :param max_depth: containers nested deeper than this are left as is.
+    :param max_keys: max number of keys, and of strings, to cache.
+    :param max_cached_length: max length of the strings cached.
+    """
+    def __init__(self, keys=(), values=(), replacement='xxxxxxxx (removed)', max_depth=20, max_keys=10000,
+                 max_cached_length=256):
+        words = '|'.join(re.escape(self.normalize(key)) for key in keys)
+        # Keys are either one of the words, or contain one, in the singular or plural.
+        self.exact_keys = re.compile(f'(?:{words})s?') if words else None
+        self.keys = re.compile(f'(?:^|_)(?:{words})s?(?:_|$)') if words else None
+        # One named group per kind of value, to tell which one matched.
+        patterns = '|'.join(f'(?P<{name if name in REDACTED_VALUES else f"_{i}"}>{REDACTED_VALUES.get(name, name)})'
+                            for i, name in enumerate(values))
+        self.values = re.compile(patterns) if patterns else None
+        self.replacement = replacement
+        self.max_depth = max_depth
+        self.max_keys = max_keys
+        self.max_cached_length = max_cached_length
+
+        self._decisions = dict.fromkeys(UNREDACTED_KEYS, _KEEP)
+        self._strings = {}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def normalize(key):
+        """
+        Returns ``key`` in snake case, so that 'clientSecret', 'Client-Secret'
+        and 'client secret' all become 'client_secret'.
+        """
+        key = _CAMEL_CASE.sub('_', key)
+        return key.lower().replace('-', '_').replace(' ', '_')
+
+    def __call__(self, logger, method_name, event_dict):
+        decisions = self._decisions
+        for key, value in event_dict.items():
+            decision = decisions.get(key)
+            if decision is None:
+                decision = self.decide(key)
+            if decision == _REDACT_STRINGS:
+                decision = _REDACT if isinstance(value, str) else _SEARCH
+            if decision == _SEARCH:
+                if type(value) not in _PLAIN_TYPES:
+                    redacted = self.redact(value, 1)
+                    if redacted is not value:
+                        event_dict[key] = redacted
+            elif decision == _REDACT and value is not None:
+                event_dict[key] = self.replacement
+        return event_dict
+
+    def decide(self, key):
+        """
+        Returns whether the value of ``key`` is redacted, or searched for secrets.
+        """
+        decision = _SEARCH
+        if self.keys is not None and isinstance(key, str):
+            normalized = self.normalize(key)
+            if self.exact_keys.fullmatch(normalized):
+                decision = _REDACT
+            elif self.keys.search(normalized):
+                decision = _REDACT_STRINGS
+        with self._lock:
+            if len(self._decisions) >= self.max_keys:
+                self._decisions = dict.fromkeys(UNREDACTED_KEYS, _KEEP)
+            self._decisions[key] = decision
+        return decision
+
+    def redact(self, value, depth):
+        """
+        Returns ``value`` with its secrets redacted, or ``value``
+        itself if there were none.
+        """
+        if isinstance(value, str):
+            if self.values is None:
+                return value
+            redacted = self._strings.get(value)
+            if redacted is None:
+                redacted = self.values.sub(self.replace, value)
+                if len(value) <= self.max_cached_length:
+                    with self._lock:
+                        if len(self._strings) >= self.max_keys:
+                            self._strings = {}
+                        # Strings without secrets are cached as
+                        # themselves, compared to the value below.
+                        self._strings[value] = redacted
+            return value if redacted == value else redacted
+        if depth > self.max_depth:
+            return value
+
+        if isinstance(value, dict):
+            decisions, copied = self._decisions, None
+            for key, item in value.items():
+                decision = decisions.get(key)
+                if decision is None:
+                    decision = self.decide(key)
+                if decision == _REDACT_STRINGS:
+                    decision = _REDACT if isinstance(item, str) else _SEARCH
+                if decision == _SEARCH:
+                    if type(item) in _PLAIN_TYPES:
+                        continue
+                    redacted = self.redact(item, depth + 1)
+                elif decision == _REDACT and item is not None:
+                    redacted = self.replacement
+                else:
+                    continue
+                if redacted is not item:
+                    if copied is None:
+                        copied = dict(value)
+                    copied[key] = redacted
+            return value if copied is None else copied
+
+        if isinstance(value, (list, tuple)):
+            copied = None
+            for i, item in enumerate(value):
+                if type(item) in _PLAIN_TYPES:
+                    continue
+                redacted = self.redact(item, depth + 1)
+                if redacted is not item:
+                    if copied is None:
+                        copied = list(value)
+                    copied[i] = redacted
+            if copied is None:
+                return value
+            return copied if isinstance(value, list) else tuple(copied)
+        return value
+
+    def replace(self, match):
+        if match.lastgroup == 'card' and not luhn_valid(match.group()):
+            return match.group()
+        return self.replacement
+
+
+_CAUSE_MESSAGE = '\nThe above exception was the direct cause of the following exception:\n\n'
+_CONTEXT_MESSAGE = '\nDuring handling of the above exception, another exception occurred:\n\n'
+_TRACEBACK_HEADER = 'Traceback (most recent call last):\n'
+
+# Exception groups are rendered by ``traceback`` without caching.
+_EXCEPTION_GROUPS = getattr(builtins, 'BaseExceptionGroup', ())
+
+
+def format_exception_only(exc):
+    """
+    Like ``traceback.format_exception_only``, without extracting the stacks
+    of chained exceptions, which ``traceback`` does even though it doesn't
+    print them.
+    """
+    if isinstance(exc, SyntaxError):
+        return traceback.format_exception_only(type(exc), exc)
+
+    exc_type = type(exc)
+    name, module = exc_type.__qualname__, exc_type.__module__
+    if module not in ('__main__', 'builtins'):
+        name = f'{module}.{name}'
+
+    try:
+        value = str(exc)
+    except Exception:
+        value = '<exception str() failed>'
+    lines = [f'{name}: {value}\n' if value else f'{name}\n']
+
+    notes = getattr(exc, '__notes__', None)
+    if isinstance(notes, (list, tuple)):
+        for note in notes:
+            try:
+                note = str(note)
+            except Exception:
+                note = '<note str() failed>'
+            lines.extend(line + '\n' for line in note.split('\n'))
+    elif notes is not None:
+        lines.extend(traceback.format_exception_only(exc_type, exc)[1:])
+    return lines
+
+
+def exception_chain(exc):
+    """
+    Returns the chain of exceptions ``traceback`` prints for ``exc``, oldest
+    first, as (message linking it to the previous one, exception) tuples.
+    """
+    chain, seen = [], set()
+    while exc is not None:
+        seen.add(id(exc))
+        cause, context = exc.__cause__, exc.__context__
+        if cause is not None and id(cause) not in seen:
+            link, previous = _CAUSE_MESSAGE, cause
+        elif context is not None and not exc.__suppress_context__ and id(context) not in seen:
+            link, previous = _CONTEXT_MESSAGE, context
+        else:
+            link, previous = None, None
+        chain.append((link, exc))
+        exc = previous
+    chain.reverse()
+    return chain
+
+
+def frames_key(tb):
+    """
+    The code locations of a traceback, that identify its formatted stack.
+    Code objects are identified by id, as hashing them is slow.
+    """
+    key = []
+    while tb is not None:
+        key.append((id(tb.tb_frame.f_code), tb.tb_lineno, tb.tb_lasti))
+        tb = tb.tb_next
+    return tuple(key)
+
+
+def frame_locations(tb):
+    """
+    Returns (code object, line number) for each frame of a traceback.
+    """
+    locations = []
+    while tb is not None:
+        locations.append((tb.tb_frame.f_code, tb.tb_lineno))
+        tb = tb.tb_next
+    return locations
+
+
+class ExceptionRenderer:
+    """
+    Replaces ``exc_info`` with the formatted ``exception``, like
+    ``structlog.processors.format_exc_info``, and adds an
+    ``exception_fingerprint`` that stays the same for exceptions
+    of the same type raised from the same code.
+
+    Formatted stacks are kept in an LRU cache keyed by exception type and
+    code locations, so a traceback that repeats is only formatted once.
+    The exception messages are formatted for every record.
+    """
+    def __init__(self, cache_size=256):
+        self.cache_size = cache_size
+        self._cache = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __call__(self, logger, method_name, event_dict):
+        exc_info = event_dict.pop('exc_info', None)
+        if exc_info:
+            if isinstance(exc_info, BaseException):
+                exc_info = (type(exc_info), exc_info, exc_info.__traceback__)
+            elif not isinstance(exc_info, tuple):
+                exc_info = sys.exc_info()
+            if exc_info[0] is not None:
+                event_dict['exception'], event_dict['exception_fingerprint'] = self.format(exc_info)
+        return event_dict
+
+    def format(self, exc_info):
+        """
+        Returns the formatted exception and its fingerprint.
+        """
+        exc_type, exc, tb = exc_info
+        if exc is None or isinstance(exc, _EXCEPTION_GROUPS):
+            text = ''.join(traceback.format_exception(exc_type, exc, tb))
+            return text.rstrip('\n'), self.fingerprint([(exc_type, frame_locations(tb))])
+
+        chain = exception_chain(exc)
+        # The traceback of the last exception is the one we were given.
+        tracebacks = [e.__traceback__ for _, e in chain[:-1]] + [tb]
+        key = tuple((link, type(e), frames_key(t)) for (link, e), t in zip(chain, tracebacks))
+
+        with self._lock:
+            cached = self._cache.get(key)
+            if cached is not None:
+                self._cache.move_to_end(key)
+
+        if cached is None:
+            stacks = tuple(_TRACEBACK_HEADER + ''.join(traceback.extract_tb(t).format()) if t is not None else ''
+                           for t in tracebacks)
+            locations = [frame_locations(t) for t in tracebacks]
+            fingerprint = self.fingerprint([(type(e), frames) for (_, e), frames in zip(chain, locations)])
+            # The locations keep the code objects alive while they're cached,
+            # so that their ids in the key can't be reused.
+            cached = stacks, fingerprint, locations
+            with self._lock:
+                self._cache[key] = cached
+                if len(self._cache) > self.cache_size:
+                    self._cache.popitem(last=False)
+
+        stacks, fingerprint, _ = cached
+        parts = []
+        for (link, e), stack in zip(chain, stacks):
+            if link:
+                parts.append(link)
+            parts.append(stack)
+            parts.extend(format_exception_only(e))
+        return ''.join(parts).rstrip('\n'), fingerprint
+
+    @staticmethod
+    def fingerprint(chain):
+        """
+        Stable hash of exception types and the code locations they were raised from.
+        """
+        parts = []
+        for exc_type, frames in chain:
+            parts.append(f'{exc_type.__module__}.{exc_type.__qualname__}')
+            parts.extend(f'{code.co_filename}:{code.co_name}:{lineno}' for code, lineno in frames)
+        return hashlib.sha1('\n'.join(parts).encode('utf-8')).hexdigest()[:16]
+
+
+# Shared renderer, so that all log paths use the same cache.
+format_exc_info = ExceptionRenderer()
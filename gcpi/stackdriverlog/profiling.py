@@ -0,0 +1,174 @@
+# -*- coding: utf-8 -*-
+"""
+Sampling profiler for slow requests, used by the request logging middleware.
+
+A single background thread samples the stacks of the threads handling
+requests every ``interval`` seconds with ``sys._current_frames()``, and
+only while there are requests being profiled. Requests that turn out to
+be fast throw their samples away, the profile of slow ones is logged in
+the folded format of flame graph tools, one ``frame;frame;frame count``
+line per stack.
+"""
+import os
+import sys
+import threading
+import time
+
+
+class Profile:
+    """
+    Samples of the stack of one thread, taken while the profile is
+    entered as a context manager. Profiles past the ``max_concurrent``
+    of the sampler stay empty.
+    """
+    __slots__ = ('sampler', 'thread_id', 'stacks', 'codes', 'samples', 'active')
+
+    def __init__(self, sampler, thread_id=None):
+        self.sampler = sampler
+        self.thread_id = thread_id
+        # Number of samples by stack, as a tuple of code object ids, leaf first.
+        self.stacks = {}
+        # Code objects of the stacks by id, kept so that their ids can't be
+        # reused while the profile is.
+        self.codes = {}
+        self.samples = 0
+        self.active = False
+
+    def __enter__(self):
+        if self.thread_id is None:
+            self.thread_id = threading.get_ident()
+        self.sampler.start(self)
+        return self
+
+    def __exit__(self, *exc_info):
+        self.sampler.stop(self)
+
+    def folded(self, max_stacks=100):
+        """
+        Returns the ``max_stacks`` most sampled stacks in folded format, root first.
+        """
+        codes, labels = self.codes, {}
+        stacks = sorted(self.stacks.items(), key=lambda item: item[1], reverse=True)[:max_stacks]
+        lines = []
+        for stack, count in stacks:
+            frames = []
+            for code_id in reversed(stack):
+                label = labels.get(code_id)
+                if label is None:
+                    label = labels[code_id] = label_of(codes[code_id])
+                frames.append(label)
+            lines.append('%s %d' % (';'.join(frames), count))
+        return '\n'.join(lines)
+
+
+def label_of(code):
+    """
+    Returns the label of ``code`` in a folded stack.
+    """
+    name = getattr(code, 'co_qualname', code.co_name)
+    return f'{name} ({code.co_filename}:{code.co_firstlineno})'
+
+
+class StackSampler:
+    """
+    Samples the stacks of the threads of active ``Profile``. At most
+    ``max_concurrent`` threads are profiled at once, to bound the time
+    spent sampling. Profiles that couldn't start are counted in ``skipped``.
+
+    :param interval: seconds between samples.
+    :param max_concurrent: max number of threads profiled at once.
+    :param max_depth: frames of a stack kept, from the leaf.
+    """
+    def __init__(self, interval=0.005, max_concurrent=4, max_depth=128):
+        self.interval = interval
+        self.max_concurrent = max_concurrent
+        self.max_depth = max_depth
+        self.skipped = 0
+
+        self._profiles = {}
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._thread = None
+
+    def configure(self, interval=None, max_concurrent=None):
+        if interval is not None:
+            self.interval = interval
+        if max_concurrent is not None:
+            self.max_concurrent = max_concurrent
+
+    def profile(self, thread_id=None):
+        """
+        Returns a ``Profile`` of the current thread, or of ``thread_id``.
+        """
+        return Profile(self, thread_id)
+
+    def start(self, profile):
+        with self._lock:
+            if len(self._profiles) >= self.max_concurrent or profile.thread_id in self._profiles:
+                self.skipped += 1
+                return False
+            profile.active = True
+            self._profiles[profile.thread_id] = profile
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name='gcpi-stack-sampler', daemon=True)
+                self._thread.start()
+            self._wakeup.set()
+        return True
+
+    def stop(self, profile):
+        with self._lock:
+            if profile.active:
+                profile.active = False
+                del self._profiles[profile.thread_id]
+
+    def _run(self):
+        wakeup = self._wakeup
+        while True:
+            wakeup.wait()
+            time.sleep(self.interval)
+            frames = sys._current_frames()
+            with self._lock:
+                profiles = list(self._profiles.values())
+                if not profiles:
+                    wakeup.clear()
+                    continue
+
+            stacks = [(profile, self.stack_of(frames.get(profile.thread_id), profile.codes))
+                      for profile in profiles]
+            del frames
+            with self._lock:
+                for profile, stack in stacks:
+                    # Profiles stopped meanwhile are being read.
+                    if profile.active and stack:
+                        profile.stacks[stack] = profile.stacks.get(stack, 0) + 1
+                        profile.samples += 1
+
+    def _after_fork(self):
+        # The sampler thread doesn't survive a fork, and the lock might have
+        # been held by it. The requests profiled are the parent's.
+        self._profiles = {}
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._thread = None
+
+    def stack_of(self, frame, codes):
+        """
+        Returns the stack of ``frame`` as a tuple of code object ids, leaf first,
+        adding its code objects to ``codes``.
+        """
+        stack = []
+        while frame is not None and len(stack) < self.max_depth:
+            code = frame.f_code
+            code_id = id(code)
+            if code_id not in codes:
+                codes[code_id] = code
+            stack.append(code_id)
+            frame = frame.f_back
+        return tuple(stack)
+
+
+# Shared sampler, so that ``max_concurrent`` holds across middleware instances.
+sampler = StackSampler()
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=sampler._after_fork)
@@ -0,0 +1,355 @@
+# -*- coding: utf-8 -*-
+"""
+JSON backends used by ``JsonProcessorFormatter`` to serialize log records.
+
+The fastest installed encoder is picked automatically, in the order
+orjson, ujson and the standard library ``json`` module. The standard
+library is always available, and is used as fallback whenever one of
+the other encoders can't serialize a record.
+"""
+import json
+import traceback
+from types import TracebackType
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import ujson
+except ImportError:
+    ujson = None
+
+
+def encode_isoformat(obj):
+    return obj.isoformat()
+
+
+def encode_traceback(obj):
+    return ''.join(traceback.format_tb(obj)).strip()
+
+
+def encode_str(obj):
+    try:
+        return str(obj)
+    except Exception:
+        return None
+
+
+# Cache of the encoding function to use for each type that the
+# encoders don't know about. Bounded in case types are created on the fly.
+_DEFAULT_HANDLERS = {}
+_DEFAULT_HANDLERS_MAX_SIZE = 512
+
+
+def default_handler(cls):
+    """
+    Returns the function used to encode objects of type ``cls``.
+    """
+    try:
+        return _DEFAULT_HANDLERS[cls]
+    except KeyError:
+        pass
+
+    if callable(getattr(cls, 'isoformat', None)):
+        handler = encode_isoformat
+    elif issubclass(cls, TracebackType):
+        handler = encode_traceback
+    else:
+        handler = encode_str
+
+    if len(_DEFAULT_HANDLERS) < _DEFAULT_HANDLERS_MAX_SIZE:
+        _DEFAULT_HANDLERS[cls] = handler
+    return handler
+
+
+def json_default(obj):
+    """
+    ``default`` hook for objects the encoders don't support natively.
+    Dates and times are written in ISO format, tracebacks are formatted
+    and anything else is converted to a string.
+    """
+    return default_handler(type(obj))(obj)
+
+
+class StdlibBackend:
+    """
+    Serializes with the standard library ``json`` module.
+    """
+    name = 'json'
+
+    def __init__(self, default=json_default, indent=None):
+        # Reuse a single encoder, ``json.dumps`` creates a new one
+        # for every call when given any arguments.
+        self._encode = json.JSONEncoder(default=default, indent=indent).encode
+
+    def dumps(self, obj):
+        return self._encode(obj)
+
+    def dumpb(self, obj):
+        return self._encode(obj).encode('utf-8')
+
+
+class OrjsonBackend:
+    """
+    Serializes with ``orjson``, falling back to the standard library
+    for values ``orjson`` refuses, like integers larger than 64 bit.
+    """
+    name = 'orjson'
+
+    def __init__(self, default=json_default, indent=None):
+        self.default = default
+        self.option = orjson.OPT_NON_STR_KEYS
+        if indent:
+            self.option |= orjson.OPT_INDENT_2
+        self.fallback = StdlibBackend(default=default, indent=indent)
+
+    def dumps(self, obj):
+        return self.dumpb(obj).decode('utf-8')
+
+    def dumpb(self, obj):
+        try:
+            return orjson.dumps(obj, default=self.default, option=self.option)
+        except TypeError:
+            return self.fallback.dumpb(obj)
+
+
+class UjsonBackend:
+    """
+    Serializes with ``ujson``, falling back to the standard library
+    for values ``ujson`` refuses.
+    """
+    name = 'ujson'
+
+    def __init__(self, default=json_default, indent=None):
+        self.default = default
+        self.indent = indent or 0
+        self.fallback = StdlibBackend(default=default, indent=indent)
+
+    def dumps(self, obj):
+        try:
+            return ujson.dumps(obj, default=self.default, indent=self.indent,
+                               escape_forward_slashes=False)
+        except (TypeError, OverflowError):
+            return self.fallback.dumps(obj)
+
+    def dumpb(self, obj):
+        return self.dumps(obj).encode('utf-8')
+
+
+class SerializerBackend:
+    """
+    Wraps a :meth:`json.dumps`-compatible callable. Used when the formatter
+    is given a custom ``json_serializer``, ``json_encoder`` or ``json_default``.
+    """
+    name = 'custom'
+
+    def __init__(self, serializer=json.dumps, default=None, cls=None, indent=None):
+        self.serializer = serializer
+        self.kwargs = {'default': default, 'cls': cls, 'indent': indent}
+
+    def dumps(self, obj):
+        result = self.serializer(obj, **self.kwargs)
+        return result.decode('utf-8') if isinstance(result, bytes) else result
+
+    def dumpb(self, obj):
+        result = self.serializer(obj, **self.kwargs)
+        return result if isinstance(result, bytes) else result.encode('utf-8')
+
+
+# Available backends, fastest first.
+BACKENDS = {
+    'orjson': OrjsonBackend if orjson is not None else None,
+    'ujson': UjsonBackend if ujson is not None else None,
+    'json': StdlibBackend,
+}
+
+
+def get_backend(name='auto', default=json_default, indent=None):
+    """
+    Returns a backend instance by name, or the fastest installed
+    backend if ``name`` is ``'auto'``.
+    """
+    if name == 'auto':
+        backend_class = next(cls for cls in BACKENDS.values() if cls is not None)
+    else:
+        try:
+            backend_class = BACKENDS[name]
+        except KeyError:
+            raise ValueError("Invalid JSON backend: '%s'" % name)
+        if backend_class is None:
+            raise ValueError("JSON backend '%s' is not installed" % name)
+    return backend_class(default=default, indent=indent)
+
+
+class _Budget:
+    """
+    Bytes left to a record being bounded, and what was truncated in it.
+    """
+    __slots__ = ('remaining', 'truncated')
+
+    def __init__(self, remaining):
+        self.remaining = remaining
+        self.truncated = {}
+
+    def truncate(self, path, key, original_size):
+        if len(self.truncated) < BoundedBackend.max_truncated_fields * 10:
+            self.truncated['.'.join(map(str, path + (key,)))] = original_size
+
+    def truncated_fields(self):
+        """
+        Returns the truncated paths closest to the top, which say the most.
+        """
+        paths = sorted(self.truncated, key=lambda path: path.count('.'))[:BoundedBackend.max_truncated_fields]
+        return {path: self.truncated[path] for path in paths}
+
+
+class BoundedBackend:
+    """
+    Wraps a backend to keep records within size limits. Records are copied
+    with containers and strings cut down to the limits, in a single pass
+    that stops adding values once ``max_bytes`` is spent, and only the
+    copy is serialized.
+
+    Records that were cut get ``truncated: true``, and ``truncated_fields``
+    with the original length of each string and the original number of
+    items of each container that was cut, by path. Only the paths closest
+    to the top are listed.
+
+    :param max_bytes: approximate max size of a serialized record. Escaped
+      and non-ASCII characters can make a record larger than estimated,
+      in which case it's bounded again with a smaller budget.
+    :param max_depth: depth below which containers are replaced by a
+      description of their size.
+    :param max_items: max number of items kept of each dict or list.
+    :param max_string_length: max length of strings, at any depth. The
+      message and the exception, at the top level, are only cut to fit
+      in ``max_bytes``.
+    """
+    name = 'bounded'
+
+    # Top level keys whose strings ``max_string_length`` doesn't apply to.
+    unlimited_keys = frozenset(('message', 'event', 'exception', 'stack_info'))
+
+    # Max number of paths listed in ``truncated_fields``.
+    max_truncated_fields = 20
+
+    # Bytes kept for the truncation marker, at most a quarter of the budget.
+    marker_bytes = 1024
+
+    def __init__(self, backend, max_bytes=None, max_depth=None, max_items=None, max_string_length=None,
+                 default=json_default):
+        self.backend = backend
+        self.max_bytes = max_bytes
+        self.max_depth = max_depth
+        self.max_items = max_items
+        self.max_string_length = max_string_length
+        self.default = default
+
+    def dumps(self, obj):
+        return self.dumpb(obj).decode('utf-8')
+
+    def dumpb(self, obj):
+        data = self.backend.dumpb(self.bound(obj))
+        if self.max_bytes and len(data) > self.max_bytes:
+            # The estimate was off, try again with a budget cut by as much.
+            budget = int(self.max_bytes * self.max_bytes / len(data) * 0.9)
+            data = self.backend.dumpb(self.bound(obj, budget))
+        return data
+
+    def bound(self, record, budget=None):
+        """
+        Returns a copy of the ``record`` dict within the limits.
+        """
+        if budget is None:
+            budget = self.max_bytes
+        state = _Budget(budget - min(self.marker_bytes, budget // 4) if budget else float('inf'))
+
+        # Scalars first, shortest first, so that the level, logger and the
+        # like are kept even when a large message or payload spends the budget.
+        values = {}
+        scalars = [(key, value) for key, value in record.items() if type(value) in _SCALARS]
+        scalars.sort(key=lambda item: len(item[1]) if type(item[1]) is str else 0)
+        for key, value in scalars:
+            values[key] = self.bound_value(value, 0, (), key, state)
+        for key, value in record.items():
+            if key not in values:
+                if state.remaining <= 0:
+                    state.truncate((), key, self.size_of(value))
+                    continue
+                values[key] = self.bound_value(value, 0, (), key, state)
+
+        # Back in the order of the record.
+        bounded = {key: values[key] for key in record if key in values}
+        if not state.truncated:
+            return bounded
+        bounded['truncated'] = True
+        bounded['truncated_fields'] = state.truncated_fields()
+        return bounded
+
+    def bound_value(self, value, depth, path, key, state):
+        cls = type(value)
+        if cls is str:
+            length = len(value)
+            allowed = max(state.remaining - 2, 0)
+            if self.max_string_length is not None and (depth or key not in self.unlimited_keys):
+                allowed = min(allowed, self.max_string_length)
+            if length > allowed:
+                state.truncate(path, key, length)
+                value = value[:allowed]
+            state.remaining -= len(value) + 2
+            return value
+
+        if cls in _SCALARS:
+            state.remaining -= 8
+            return value
+
+        if isinstance(value, dict):
+            if self.max_depth is not None and depth >= self.max_depth:
+                return self.describe(value, 'dict', path, key, state)
+            child_path = path + (key,)
+            bounded = {}
+            state.remaining -= 2
+            for index, (child_key, child) in enumerate(value.items()):
+                if state.remaining <= 0 or (self.max_items is not None and index >= self.max_items):
+                    state.truncate(path, key, len(value))
+                    break
+                if type(child_key) is not str:
+                    child_key = str(child_key)
+                state.remaining -= len(child_key) + 4
+                bounded[child_key] = self.bound_value(child, depth + 1, child_path, child_key, state)
+            return bounded
+
+        if isinstance(value, (list, tuple, set, frozenset)):
+            if self.max_depth is not None and depth >= self.max_depth:
+                return self.describe(value, 'list', path, key, state)
+            child_path = path + (key,)
+            bounded = []
+            state.remaining -= 2
+            for index, child in enumerate(value):
+                if state.remaining <= 0 or (self.max_items is not None and index >= self.max_items):
+                    state.truncate(path, key, len(value))
+                    break
+                state.remaining -= 1
+                bounded.append(self.bound_value(child, depth + 1, child_path, index, state))
+            return bounded
+
+        # Anything else is encoded up front, to know its size.
+        return self.bound_value(self.default(value), depth, path, key, state)
+
+    def describe(self, container, kind, path, key, state):
+        state.truncate(path, key, len(container))
+        description = '<%s of %d items>' % (kind, len(container))
+        state.remaining -= len(description) + 2
+        return description
+
+    @staticmethod
+    def size_of(value):
+        try:
+            return len(value)
+        except TypeError:
+            return None
+
+
+_SCALARS = frozenset((str, int, float, bool, type(None)))
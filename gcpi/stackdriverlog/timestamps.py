@@ -0,0 +1,43 @@
+# -*- coding: utf-8 -*-
+"""
+RFC 3339 timestamps with nanoseconds, for the ``timestamp`` field Cloud Logging
+reads the time of an entry from.
+"""
+import time
+
+
+class TimestampFormatter:
+    """
+    Formats POSIX timestamps, like ``LogRecord.created``, as UTC RFC 3339
+    strings with nine fractional digits. The date and time up to the second
+    is cached, so ``time.strftime`` only runs once per second of records.
+    """
+    def __init__(self):
+        self._cached = (None, None)
+
+    def __call__(self, timestamp):
+        cached_seconds, prefix = self._cached
+        seconds = int(timestamp)
+        if seconds != cached_seconds or timestamp < 0:
+            seconds, nanos = split_timestamp(timestamp)
+            prefix = time.strftime('%Y-%m-%dT%H:%M:%S', time.gmtime(seconds))
+            # A tuple, so that threads never see a prefix of another second.
+            self._cached = (seconds, prefix)
+            return f'{prefix}.{nanos:09d}Z'
+        return f'{prefix}.{int((timestamp - seconds) * 1e9):09d}Z'
+
+
+def split_timestamp(timestamp):
+    """
+    Returns the whole seconds and the nanoseconds of a POSIX timestamp.
+    """
+    seconds = int(timestamp)
+    nanos = int((timestamp - seconds) * 1e9)
+    if nanos < 0:
+        # Before 1970, the fraction is counted back from the next second.
+        seconds, nanos = seconds - 1, nanos + 1000000000
+    return seconds, nanos
+
+
+# Shared by everything that formats record times.
+format_timestamp = TimestampFormatter()
@@ -21,10 +21,22 @@ setuptools.setup(
     install_requires=[
         'structlog',
     ],
+    entry_points={
+        'console_scripts': [
+            'gcpi-convert-logs = gcpi.stackdriverlog.convert:main',
+        ],
+    },
     classifiers=[
         "Programming Language :: Python :: 3",
+        "Programming Language :: Python :: 3 :: Only",
+        "Programming Language :: Python :: 3.7",
+        "Programming Language :: Python :: 3.8",
+        "Programming Language :: Python :: 3.9",
+        "Programming Language :: Python :: 3.10",
+        "Programming Language :: Python :: 3.11",
+        "Programming Language :: Python :: 3.12",
         "License :: OSI Approved :: MIT License",
         "Operating System :: OS Independent",
     ],
-    python_requires='>=3.6',
+    python_requires='>=3.7',
 )
\ No newline at end of file